@@ -1,10 +1,63 @@
 import os
 import asyncio
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import cloudinary
 import cloudinary.uploader
 from cloudinary.utils import cloudinary_url
 
+# Chunk size for chunked uploads; Cloudinary requires every chunk but the last to be >= 5MB
+STREAM_CHUNK_SIZE = 6 * 1024 * 1024
+
+# Generated by Cloudinary in the background after upload, so we don't have to encode it ourselves
+EAGER_TRANSFORMATIONS = [
+    {"width": 1280, "height": 720, "crop": "limit", "video_codec": "auto", "format": "mp4"}
+]
+
+# Chunks read ahead from the stream while the previous one is uploading, so the producer never stalls on the pipe
+STREAM_PREFETCH_CHUNKS = 4
+
+class _AsyncReaderIO:
+    """Blocking file-like view of an asyncio.StreamReader, for use from a worker thread
+    
+    A task on the event loop keeps draining the reader into a bounded queue of
+    fixed-size chunks, so ffmpeg keeps encoding while a chunk is being uploaded.
+    """
+    def __init__(self, reader: asyncio.StreamReader, loop: asyncio.AbstractEventLoop, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.reader = reader
+        self.loop = loop
+        self.chunks: asyncio.Queue = asyncio.Queue(maxsize=STREAM_PREFETCH_CHUNKS)
+        self._prefetch = loop.create_task(self._fill(chunk_size))
+    
+    async def _read(self, size: int) -> bytes:
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+    
+    async def _fill(self, size: int):
+        try:
+            while True:
+                chunk = await self._read(size)
+                if chunk:
+                    await self.chunks.put(chunk)
+                if len(chunk) < size:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Stream read failed: {e}")
+        
+        # An empty chunk marks the end of the stream
+        await self.chunks.put(b'')
+    
+    def read(self, size: int = STREAM_CHUNK_SIZE) -> bytes:
+        """Return the next chunk; chunks are always STREAM_CHUNK_SIZE except the last"""
+        return asyncio.run_coroutine_threadsafe(self.chunks.get(), self.loop).result()
+    
+    def close(self):
+        """Stop reading ahead, e.g. after a failed upload"""
+        self._prefetch.cancel()
+
 class CloudinaryUploader:
     def __init__(self):
         # Initialize Cloudinary with environment variable
@@ -12,31 +65,88 @@ class CloudinaryUploader:
         if not cloudinary_url_env:
             raise ValueError("CLOUDINARY_URL environment variable is required")
         
-        cloudinary.config(cloudinary_url=cloudinary_url_env)
+        config = cloudinary.config(cloudinary_url=cloudinary_url_env)
+        
+        # Resolved once so each upload call doesn't rebuild the options or look up credentials again
+        self._upload_defaults = {
+            "resource_type": "video",
+            "overwrite": True,
+            "quality": "auto",
+            "format": "mp4",
+            "eager": EAGER_TRANSFORMATIONS,
+            "eager_async": True,
+            "cloud_name": config.cloud_name,
+            "api_key": config.api_key,
+            "api_secret": config.api_secret
+        }
     
-    async def upload(self, file_path: str) -> Dict[str, Any]:
-        """Upload video to Cloudinary"""
+    async def upload(self, file_path: str, delete_after: bool = False) -> Dict[str, Any]:
+        """Upload video to Cloudinary, optionally deleting the local file once it's sent"""
         try:
-            # Check file size (Cloudinary has limits)
-            file_size = os.path.getsize(file_path)
-            if file_size > 100 * 1024 * 1024:  # 100MB limit
-                return {"success": False, "error": "File too large (max 100MB)"}
-            
-            # Upload to Cloudinary
+            # Chunked upload sends the file in 6MB parts, so the 100MB single-request limit no longer applies
             result = await asyncio.to_thread(
-                cloudinary.uploader.upload,
+                cloudinary.uploader.upload_large,
                 file_path,
-                resource_type="video",
+                chunk_size=STREAM_CHUNK_SIZE,
                 public_id=f"youtube_downloads/{os.path.basename(file_path)}",
-                overwrite=True,
-                quality="auto",
-                format="mp4"
+                **self._upload_defaults
             )
             
+            # Converted files may live on tmpfs, so free the memory right away
+            if delete_after:
+                try:
+                    os.unlink(file_path)
+                except OSError as e:
+                    print(f"Failed to remove {file_path}: {e}")
+            
             if result.get('secure_url'):
                 return {"success": True, "url": result['secure_url']}
             else:
                 return {"success": False, "error": "Failed to get upload URL"}
                 
         except Exception as e:
-            return {"success": False, "error": f"Upload failed: {str(e)}"}
\ No newline at end of file
+            return {"success": False, "error": f"Upload failed: {str(e)}"}
+    
+    async def upload_stream(self, reader: asyncio.StreamReader, public_id: str) -> Dict[str, Any]:
+        """Upload a video to Cloudinary while it is still being produced (e.g. ffmpeg stdout)"""
+        try:
+            stream = _AsyncReaderIO(reader, asyncio.get_running_loop())
+            try:
+                result = await asyncio.to_thread(self._upload_chunked_stream, stream, public_id)
+            finally:
+                stream.close()
+            
+            if result and result.get('secure_url'):
+                return {"success": True, "url": result['secure_url']}
+            else:
+                return {"success": False, "error": "Failed to get upload URL"}
+                
+        except Exception as e:
+            return {"success": False, "error": f"Stream upload failed: {str(e)}"}
+    
+    def _upload_chunked_stream(self, stream: _AsyncReaderIO, public_id: str) -> Optional[Dict[str, Any]]:
+        """Send a stream of unknown length through Cloudinary's chunked upload API"""
+        upload_id = cloudinary.utils.random_public_id()
+        offset = 0
+        result = None
+        
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        while chunk:
+            # The total size is only known once the final chunk has been read
+            next_chunk = stream.read(STREAM_CHUNK_SIZE)
+            total = offset + len(chunk) if not next_chunk else -1
+            
+            result = cloudinary.uploader.upload_large_part(
+                ("stream.mp4", chunk),
+                http_headers={
+                    "Content-Range": f"bytes {offset}-{offset + len(chunk) - 1}/{total}",
+                    "X-Unique-Upload-Id": upload_id
+                },
+                public_id=public_id,
+                **self._upload_defaults
+            )
+            
+            offset += len(chunk)
+            chunk = next_chunk
+        
+        return result
\ No newline at end of file
@@ -1,129 +1,693 @@
 import os
 import asyncio
+import shutil
 import subprocess
-from typing import Dict, Any
-from utils import validate_file_with_ffprobe
+import collections
+from typing import Dict, Any, List, Optional, Tuple
+from utils import validate_file_with_ffprobe, probe_video_file, spawn_subprocess, stat_file, usable_hw_encoders
+
+# Set LOG_FFMPEG=1 to capture ffmpeg progress and errors; otherwise its output is discarded
+LOG_FFMPEG = os.getenv("LOG_FFMPEG", "0") == "1"
+# Lines of stderr / -progress output kept for the failure log; older lines are dropped as they arrive
+FFMPEG_LOG_TAIL_LINES = 64
+
+# Absolute path, so subprocess can start ffmpeg with posix_spawn
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+
+# ffmpeg output target used when the encoded video is streamed instead of written to disk
+PIPE_OUTPUT = 'pipe:1'
+
+# Inputs already in these codecs inside an MP4 container only need a remux
+REMUXABLE_CODECS = {'h264', 'hevc'}
+MP4_FORMAT_NAME = 'mov,mp4,m4a'
+
+# Conversions submitted within this window (seconds) share one ffmpeg process
+BATCH_WINDOW = 0.05
+BATCH_MAX_SIZE = 8
+# Worker tasks that can each be running a batch at the same time
+BATCH_WORKERS = os.cpu_count() or 1
+
+# Converted files only feed the uploader, so keep them in RAM when tmpfs is available
+TMPFS_ROOT = '/dev/shm'
+# tmpfs space reserved for each output file a conversion writes, as a multiple of the input size;
+# jobs only use tmpfs while it has room for their reservation on top of everyone else's
+TMPFS_HEADROOM = 2
+# A failed ffmpeg run into tmpfs counts as having run out of space (ENOSPC) if less than
+# this was left free when it exited; its exit code alone doesn't say
+TMPFS_FULL_FREE = 1024 * 1024
+
+# Fragmented MP4 writes moov up front, so there is no second pass to move it like +faststart
+FRAGMENTED_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+
+# Input probe results kept per converter; the oldest are dropped beyond this
+PROBE_CACHE_SIZE = 1024
+
+def _mp4_complete(path: str) -> bool:
+    """Cheap check that ffmpeg finished an MP4 by walking its top-level boxes
+    
+    A finished file has a moov box and its last box ends exactly at EOF. A run
+    that died part way leaves a box that overshoots the end, or (faststart) an
+    mdat with no moov after it. Fragmented output has its empty moov up front
+    from the start, so there it's the box sizes that show truncation.
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            pos = 0
+            has_moov = False
+            while pos < size:
+                f.seek(pos)
+                header = f.read(16)
+                if len(header) < 8:
+                    return False
+                box_size = int.from_bytes(header[:4], 'big')
+                if box_size == 1:
+                    # 64-bit size follows the type
+                    if len(header) < 16:
+                        return False
+                    box_size = int.from_bytes(header[8:16], 'big')
+                elif box_size == 0:
+                    # "Extends to EOF", which only an mdat that is still being written has
+                    return False
+                if box_size < 8:
+                    return False
+                has_moov = has_moov or header[4:8] == b'moov'
+                pos += box_size
+            return has_moov and pos == size
+    except OSError:
+        return False
 
 class VideoConverter:
+    # Software encoder settings, override per deployment (e.g. slower presets for smaller files)
+    hevc_preset = 'ultrafast'
+    hevc_crf = '28'
+    h264_preset = 'superfast'
+    h264_crf = '23'
+    tune = 'zerolatency'
+    threads = os.cpu_count() or 1
+    
+    # Limits concurrent ffmpeg processes across all converters
+    _ffmpeg_slots = asyncio.Semaphore(os.cpu_count() or 1)
+    
     def __init__(self):
-        self.converted_dir = "converted"
+        self.disk_dir = "converted"
+        if os.path.isdir(TMPFS_ROOT):
+            self.converted_dir = os.environ.get("CONVERT_TMPDIR", os.path.join(TMPFS_ROOT, "converted"))
+        else:
+            self.converted_dir = os.environ.get("CONVERT_TMPDIR", self.disk_dir)
+        os.makedirs(self.converted_dir, exist_ok=True)
+        os.makedirs(self.disk_dir, exist_ok=True)
+        # Set CONVERT_TO_DISK=1 to always write converted files, e.g. for debugging
+        self.stream_output = os.getenv("CONVERT_TO_DISK", "0") != "1"
+        # Set CONVERT_FASTSTART=1 for non-fragmented files that are kept as downloads
+        self.fragmented_output = os.getenv("CONVERT_FASTSTART", "0") != "1"
+        # Best usable hardware encoders, filled in by _detect_encoders()
+        self.hevc_encoder: Optional[Tuple[str, List[str]]] = None
+        self.h264_encoder: Optional[Tuple[str, List[str]]] = None
+        self._encoders_detected = False
+        # Input probe results keyed by (path, inode, mtime_ns, size)
+        self._probe_cache: Dict[Tuple[str, int, int, int], Optional[Dict[str, Any]]] = {}
+        # Pending (input_path, future) jobs for submit()
+        self._batch_queue: asyncio.Queue = asyncio.Queue()
+        self._batch_workers: set = set()
+        self._collecting_workers = 0
+        # Bytes of converted_dir promised to conversions that are still writing their outputs
+        self._tmpfs_reserved = 0
+        # Failed ffmpeg runs that found converted_dir full, see _note_tmpfs_full()
+        self._tmpfs_full_runs = 0
+    
+    async def _detect_encoders(self):
+        """Pick the best GPU encoders (NVENC / AMF / QSV / VideoToolbox) that pass a trial encode"""
+        if self._encoders_detected:
+            return
+        self._encoders_detected = True
+        
+        # Trial encodes run once per process and are shared with VideoDownloader
+        hevc, h264 = await asyncio.to_thread(usable_hw_encoders)
+        self.hevc_encoder = hevc[0] if hevc else None
+        self.h264_encoder = h264[0] if h264 else None
+        print(f"Hardware encoders: HEVC={self.hevc_encoder[0] if self.hevc_encoder else 'none'}, "
+              f"H.264={self.h264_encoder[0] if self.h264_encoder else 'none'}")
+    
+    async def convert(self, input_path: str, uploader=None, force_reencode: bool = False) -> Dict[str, Any]:
+        """Convert video to HEVC or H.264, or remux it, whichever succeeds first
         
-    async def convert(self, input_path: str) -> Dict[str, Any]:
-        """Convert video to HEVC, fallback to H.264, then remux"""
+        Inputs that are already H.264/HEVC in an MP4 container are only remuxed
+        unless force_reencode is set, which rules out every stream-copy attempt.
+        When an uploader is given the encoded video is piped from ffmpeg straight
+        into CloudinaryUploader.upload_stream and never touches the disk.
+        """
         try:
             # Validate input file first
-            if not await validate_file_with_ffprobe(input_path):
+            info = await self._probe_input(input_path)
+            if not info:
                 return {"success": False, "error": "Input file is not a valid video"}
             
             filename = os.path.basename(input_path)
             name, ext = os.path.splitext(filename)
-            output_path = os.path.join(self.converted_dir, f"{name}_converted.mp4")
+            output_name = f"{name}_converted.mp4"
+            remuxable = not force_reencode and self._is_remuxable(info)
             
-            # Try HEVC first
-            hevc_success = await self._convert_hevc(input_path, output_path)
-            if hevc_success:
-                return {"success": True, "file_path": output_path}
+            if uploader is not None and self.stream_output:
+                public_id = f"youtube_downloads/{output_name}"
+                if remuxable:
+                    result = await self._remux(input_path, PIPE_OUTPUT, uploader, public_id)
+                    if result["success"]:
+                        return result
+                    print("Remux of compatible input failed, re-encoding instead")
+                
+                await self._detect_encoders()
+                return await self._convert_streaming(input_path, uploader, public_id, allow_remux=not force_reencode)
             
-            # Fallback to H.264
-            h264_success = await self._convert_h264(input_path, output_path)
-            if h264_success:
-                return {"success": True, "file_path": output_path}
+            await self._detect_encoders()
             
-            # Final fallback: remux without re-encoding
-            remux_success = await self._remux(input_path, output_path)
-            if remux_success:
-                return {"success": True, "file_path": output_path}
+            # A stream copy of VP9/AV1 into MP4 usually succeeds too, so only race one for compatible inputs;
+            # other inputs only fall back to it once both encodes have failed, and never when forced
+            async def convert_file(output_path: str) -> Dict[str, Any]:
+                if remuxable:
+                    return await self._convert_speculative(input_path, name, output_path)
+                result = await self._convert_encoded(input_path, name, output_path)
+                if not result["success"] and not force_reencode:
+                    print("Both encoders failed, trying simple remux...")
+                    result = await self._remux(input_path, output_path)
+                return result
             
-            return {"success": False, "error": "All conversion methods failed"}
+            # The race writes a remux and two encodes at the same time, the encode alone two
+            output_dir, reserved = await self._reserve_output_dir(input_path, 3 if remuxable else 2)
+            tmpfs_full_runs = self._tmpfs_full_runs
+            try:
+                result = await convert_file(os.path.join(output_dir, output_name))
+            finally:
+                self._tmpfs_reserved -= reserved
             
+            # Corrupt or unencodable inputs would just fail again, so only
+            # retry on disk when tmpfs filled up while this conversion ran
+            if not result["success"] and reserved and self._tmpfs_full_runs != tmpfs_full_runs:
+                print(f"{output_dir} ran out of space, retrying in {self.disk_dir}")
+                result = await convert_file(os.path.join(self.disk_dir, output_name))
+            return result
+        
         except Exception as e:
             return {"success": False, "error": f"Conversion error: {str(e)}"}
     
-    async def _convert_hevc(self, input_path: str, output_path: str) -> bool:
-        """Convert to HEVC (H.265)"""
+    async def submit(self, input_path: str) -> Dict[str, Any]:
+        """Queue a conversion; jobs submitted close together are encoded by a single ffmpeg"""
+        future = asyncio.get_running_loop().create_future()
+        self._batch_queue.put_nowait((input_path, future))
+        
+        # Start another worker only if every existing one is busy encoding, so that
+        # jobs arriving together still land in the same batch
+        if self._collecting_workers == 0 and len(self._batch_workers) < BATCH_WORKERS:
+            # Counted as collecting from creation, before the task first runs
+            self._collecting_workers += 1
+            worker = asyncio.create_task(self._run_batches())
+            self._batch_workers.add(worker)
+            worker.add_done_callback(self._batch_workers.discard)
+        return await future
+    
+    async def _run_batches(self):
+        """Drain the submit() queue, coalescing jobs that arrive within BATCH_WINDOW"""
+        loop = asyncio.get_running_loop()
+        
+        try:
+            while not self._batch_queue.empty():
+                jobs = [self._batch_queue.get_nowait()]
+                deadline = loop.time() + BATCH_WINDOW
+                while len(jobs) < BATCH_MAX_SIZE:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        jobs.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                
+                self._collecting_workers -= 1
+                try:
+                    results = await self.convert_batch([input_path for input_path, _ in jobs])
+                except Exception as e:
+                    results = [{"success": False, "error": f"Conversion error: {str(e)}"}] * len(jobs)
+                finally:
+                    self._collecting_workers += 1
+                
+                for (_, future), result in zip(jobs, results):
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self._collecting_workers -= 1
+    
+    async def convert_batch(self, input_paths: List[str]) -> List[Dict[str, Any]]:
+        """Encode several inputs to HEVC with one ffmpeg process
+        
+        Inputs that only need a remux, and any input whose batched output is bad,
+        go through convert() on their own so one broken file can't fail the rest.
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(input_paths)
+        batch = []
+        reserved = 0
+        
+        for i, input_path in enumerate(input_paths):
+            info = await self._probe_input(input_path)
+            if info and not self._is_remuxable(info):
+                name = os.path.splitext(os.path.basename(input_path))[0]
+                output_dir, input_reserved = await self._reserve_output_dir(input_path, 1)
+                reserved += input_reserved
+                batch.append((i, input_path, os.path.join(output_dir, f"{name}_converted.mp4")))
+        
+        try:
+            await self._run_batch(batch, results)
+        finally:
+            self._tmpfs_reserved -= reserved
+        
+        # Anything the batch didn't produce is converted individually
+        individual = [i for i, result in enumerate(results) if result is None]
+        converted = await asyncio.gather(*(self.convert(input_paths[i]) for i in individual))
+        for i, result in zip(individual, converted):
+            results[i] = result
+        
+        return results
+    
+    async def _run_batch(self, batch: List[Tuple[int, str, str]], results: List[Optional[Dict[str, Any]]]):
+        """Encode the (result index, input path, output path) jobs with one ffmpeg and fill in the results it produced"""
+        if len(batch) > 1:
+            await self._detect_encoders()
+            if self.hevc_encoder:
+                encoder, encoder_args = self.hevc_encoder
+                video_args = ['-c:v', encoder, *encoder_args]
+            else:
+                video_args = self._x265_args()
+            
+            cmd = [FFMPEG]
+            for _, input_path, _ in batch:
+                cmd += ['-i', input_path]
+            for n, (_, _, output_path) in enumerate(batch):
+                cmd += [
+                    '-map', f'{n}:v:0', '-map', f'{n}:a?',
+                    *video_args,
+                    '-c:a', 'aac',
+                    '-b:a', '128k',
+                    *self._output_args(output_path)
+                ]
+            
+            returncode = await self._exec_ffmpeg(cmd)
+            if returncode == 0:
+                # Outputs that need ffprobe are checked concurrently rather than one after another
+                checks = await asyncio.gather(*(self._check_output(output_path) for _, _, output_path in batch))
+                for (i, _, output_path), ok in zip(batch, checks):
+                    if ok:
+                        results[i] = {"success": True, "file_path": output_path}
+    
+    async def _convert_speculative(self, input_path: str, name: str, output_path: str) -> Dict[str, Any]:
+        """Race a remux of an already-compatible input against an encode and keep the first successful output
+        
+        The encode only wins if the remux fails, so a broken container costs no
+        extra time.
+        """
+        output_dir = os.path.dirname(output_path)
+        remux_path = os.path.join(output_dir, f"{name}_remux.mp4")
+        encoded_path = os.path.join(output_dir, f"{name}_encoded.mp4")
+        # Created in order of preference when several finish together; remux is lossless
+        tasks = [
+            asyncio.create_task(self._remux(input_path, remux_path)),
+            asyncio.create_task(self._convert_encoded(input_path, name, encoded_path)),
+        ]
+        pending = set(tasks)
+        winner = None
+        
         try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.result()["success"]:
+                        winner = task.result()["file_path"]
+                        break
+        finally:
+            # Cancelling a losing attempt terminates its ffmpeg process
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            self._discard_outputs((remux_path, encoded_path), winner)
+        
+        if winner is None:
+            return {"success": False, "error": "All conversion methods failed"}
+        
+        os.replace(winner, output_path)
+        return {"success": True, "file_path": output_path}
+    
+    async def _convert_encoded(self, input_path: str, name: str, output_path: str) -> Dict[str, Any]:
+        """Encode HEVC and H.264 side by side and keep the preferred one that succeeds"""
+        output_dir = os.path.dirname(output_path)
+        hevc_path = os.path.join(output_dir, f"{name}_hevc.mp4")
+        h264_path = os.path.join(output_dir, f"{name}_h264.mp4")
+        winner = None
+        
+        try:
+            result = await self._convert_split(input_path, hevc_path, h264_path)
+            if result["success"]:
+                winner = result["file_path"]
+        finally:
+            self._discard_outputs((hevc_path, h264_path), winner)
+        
+        if winner is None:
+            return {"success": False, "error": "All conversion methods failed"}
+        
+        os.replace(winner, output_path)
+        return {"success": True, "file_path": output_path}
+    
+    @staticmethod
+    def _discard_outputs(paths, keep: Optional[str]):
+        """Delete the outputs of attempts that lost or failed"""
+        for path in paths:
+            if path != keep:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+    
+    async def _convert_split(self, input_path: str, hevc_path: str, h264_path: str) -> Dict[str, Any]:
+        """Decode once and encode HEVC and H.264 side by side, preferring the HEVC output
+        
+        The H.264 copy is there for free if the HEVC output turns out bad. If the
+        combined run fails (e.g. a hardware encoder errors out) the two encodes are
+        retried separately.
+        """
+        try:
+            if self.hevc_encoder:
+                encoder, encoder_args = self.hevc_encoder
+                hevc_args = ['-c:v', encoder, *encoder_args]
+            else:
+                hevc_args = self._x265_args()
+            if self.h264_encoder:
+                encoder, encoder_args = self.h264_encoder
+                h264_args = ['-c:v', encoder, *encoder_args]
+            else:
+                h264_args = self._x264_args()
+            
             cmd = [
-                'ffmpeg', '-i', input_path,
-                '-c:v', 'libx265',
-                '-preset', 'medium',
-                '-crf', '28',
+                FFMPEG, '-i', input_path,
+                '-filter_complex', '[0:v]split=2[v1][v2]',
+                '-map', '[v1]', '-map', '0:a?',
+                *hevc_args,
                 '-c:a', 'aac',
                 '-b:a', '128k',
-                '-movflags', '+faststart',
-                '-y', output_path
+                *self._output_args(hevc_path),
+                '-map', '[v2]', '-map', '0:a?',
+                *h264_args,
+                '-c:a', 'aac',
+                '-b:a', '128k',
+                *self._output_args(h264_path)
             ]
             
-            process = await asyncio.create_subprocess_exec(
+            returncode = await self._exec_ffmpeg(cmd)
+            if returncode == 0:
+                for path in (hevc_path, h264_path):
+                    if await self._check_output(path):
+                        return {"success": True, "file_path": path}
+            else:
+                await self._note_tmpfs_full(hevc_path)
+            print(f"Combined HEVC/H.264 encode failed ({returncode}), encoding separately")
+        
+        except Exception as e:
+            print(f"Combined HEVC/H.264 encode failed: {e}")
+        
+        result = await self._convert_hevc(input_path, hevc_path)
+        if result["success"]:
+            return result
+        return await self._convert_h264(input_path, h264_path)
+    
+    async def _convert_streaming(self, input_path: str, uploader, public_id: str, allow_remux: bool = True) -> Dict[str, Any]:
+        """Stream HEVC, then H.264, then (if allow_remux) a remux into the uploader until one succeeds
+        
+        Attempts run one at a time because a cancelled stream would still finalize
+        its partial upload.
+        """
+        # Try HEVC first
+        result = await self._convert_hevc(input_path, PIPE_OUTPUT, uploader, public_id)
+        if result["success"]:
+            return result
+        
+        # Fallback to H.264
+        result = await self._convert_h264(input_path, PIPE_OUTPUT, uploader, public_id)
+        if result["success"]:
+            return result
+        
+        # Final fallback: remux without re-encoding
+        if allow_remux:
+            result = await self._remux(input_path, PIPE_OUTPUT, uploader, public_id)
+            if result["success"]:
+                return result
+        
+        return {"success": False, "error": "All conversion methods failed"}
+    
+    async def _tmpfs_free(self) -> Optional[int]:
+        """Free bytes in converted_dir, or None if it can't be checked"""
+        try:
+            usage = await asyncio.to_thread(shutil.disk_usage, self.converted_dir)
+        except OSError:
+            return None
+        return usage.free
+    
+    async def _note_tmpfs_full(self, output_path: str):
+        """After a failed ffmpeg run, count it if its output was in tmpfs and tmpfs is now (nearly) full
+        
+        Checked straight away, before the failed attempt's files are deleted
+        and give the space back.
+        """
+        if self.converted_dir == self.disk_dir or os.path.dirname(output_path) != self.converted_dir:
+            return
+        free = await self._tmpfs_free()
+        if free is not None and free < TMPFS_FULL_FREE:
+            self._tmpfs_full_runs += 1
+    
+    async def _reserve_output_dir(self, input_path: str, outputs: int) -> Tuple[str, int]:
+        """Use the (tmpfs) converted_dir unless it is too full for this job's outputs
+        
+        Returns the directory and the bytes reserved in it; the caller takes them
+        off _tmpfs_reserved again once its ffmpeg runs are over.
+        """
+        if self.converted_dir == self.disk_dir:
+            return self.disk_dir, 0
+        st = await stat_file(input_path)
+        free = await self._tmpfs_free()
+        needed = TMPFS_HEADROOM * st.st_size * outputs if st is not None else 0
+        if st is None or free is None or free < self._tmpfs_reserved + needed:
+            print(f"Not enough space in {self.converted_dir}, writing to {self.disk_dir}")
+            return self.disk_dir, 0
+        self._tmpfs_reserved += needed
+        return self.converted_dir, needed
+    
+    async def _probe_input(self, input_path: str) -> Optional[Dict[str, Any]]:
+        """ffprobe the input once per (path, inode, mtime, size)"""
+        st = await stat_file(input_path)
+        if st is None:
+            return None
+        
+        # The inode catches a file replaced in place within the same mtime tick
+        key = (input_path, st.st_ino, st.st_mtime_ns, st.st_size)
+        if key not in self._probe_cache:
+            if len(self._probe_cache) >= PROBE_CACHE_SIZE:
+                del self._probe_cache[next(iter(self._probe_cache))]
+            self._probe_cache[key] = await probe_video_file(input_path)
+        return self._probe_cache[key]
+    
+    def _is_remuxable(self, info: Dict[str, Any]) -> bool:
+        """Whether the input only needs its container rewritten (e.g. to fragment it)"""
+        return (info.get("video_codec") in REMUXABLE_CODECS
+                and info.get("format_name", "").startswith(MP4_FORMAT_NAME))
+    
+    def _output_args(self, output_path: str) -> List[str]:
+        """ffmpeg output options for a file path or the stdout pipe"""
+        if output_path == PIPE_OUTPUT:
+            # Fragmented MP4 never seeks back to rewrite moov, so it can go to a pipe
+            return ['-f', 'mp4', '-movflags', FRAGMENTED_MOVFLAGS, PIPE_OUTPUT]
+        movflags = FRAGMENTED_MOVFLAGS if self.fragmented_output else '+faststart'
+        return ['-movflags', movflags, '-y', output_path]
+    
+    async def _run_ffmpeg(self, cmd: List[str], output_path: str, uploader=None, public_id: Optional[str] = None) -> Dict[str, Any]:
+        """Run an ffmpeg command and validate the output file, or stream it to the uploader"""
+        if uploader is not None:
+            return await self._run_ffmpeg_streaming(cmd, uploader, public_id)
+        
+        returncode = await self._exec_ffmpeg(cmd)
+        
+        if returncode == 0 and await self._check_output(output_path):
+            return {"success": True, "file_path": output_path}
+        if returncode != 0:
+            await self._note_tmpfs_full(output_path)
+        
+        return {"success": False, "error": f"ffmpeg exited with code {returncode}"}
+    
+    @staticmethod
+    async def _drain(stream: asyncio.StreamReader, tail: collections.deque):
+        """Read a subprocess pipe to EOF, keeping only its last lines"""
+        async for line in stream:
+            tail.append(line)
+    
+    async def _exec_ffmpeg(self, cmd: List[str]) -> int:
+        """Run ffmpeg to completion and return its exit code"""
+        if LOG_FFMPEG:
+            # Compact key=value progress on stdout instead of the per-frame stats line
+            cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+        output = asyncio.subprocess.PIPE if LOG_FFMPEG else asyncio.subprocess.DEVNULL
+        
+        async with self._ffmpeg_slots:
+            process = await spawn_subprocess(
+                *cmd,
+                stdout=output,
+                stderr=output
+            )
+            
+            try:
+                if LOG_FFMPEG:
+                    # Progress lines arrive for the whole run, so stream them instead of buffering everything
+                    stdout = collections.deque(maxlen=FFMPEG_LOG_TAIL_LINES)
+                    stderr = collections.deque(maxlen=FFMPEG_LOG_TAIL_LINES)
+                    await asyncio.gather(
+                        self._drain(process.stdout, stdout),
+                        self._drain(process.stderr, stderr),
+                        process.wait()
+                    )
+                    if process.returncode != 0:
+                        print(f"ffmpeg failed ({process.returncode}): {b''.join(stderr).decode(errors='ignore')[-2000:]}")
+                        print(f"Last progress: {b''.join(stdout).decode(errors='ignore')[-500:]}")
+                else:
+                    await process.wait()
+            except asyncio.CancelledError:
+                # A speculative attempt lost the race, don't leave ffmpeg running
+                process.terminate()
+                await process.wait()
+                raise
+        
+        return process.returncode
+    
+    async def _check_output(self, output_path: str) -> bool:
+        """Check a file written by an ffmpeg run that exited cleanly"""
+        st = await stat_file(output_path)
+        if st is None:
+            return False
+        # Only fall back to ffprobe if the file looks truncated
+        if st.st_size > 1024 and await asyncio.to_thread(_mp4_complete, output_path):
+            return True
+        return await validate_file_with_ffprobe(output_path)
+    
+    async def _run_ffmpeg_streaming(self, cmd: List[str], uploader, public_id: str) -> Dict[str, Any]:
+        """Run ffmpeg with its stdout fed directly into a streaming upload"""
+        async with self._ffmpeg_slots:
+            # stderr is not read while streaming, so it must not be a pipe that can fill up
+            process = await spawn_subprocess(
                 *cmd,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+                stderr=asyncio.subprocess.DEVNULL
             )
             
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode == 0 and os.path.exists(output_path):
-                return await validate_file_with_ffprobe(output_path)
+            result = {"success": False, "error": "Upload did not complete"}
+            try:
+                result = await uploader.upload_stream(process.stdout, public_id=public_id)
+            finally:
+                # A failed upload stops reading stdout, which would leave ffmpeg blocked forever
+                if process.returncode is None and not result["success"]:
+                    process.kill()
+                await process.wait()
+        
+        if process.returncode != 0:
+            return {"success": False, "error": f"ffmpeg exited with code {process.returncode}"}
+        
+        return result
+    
+    def _x265_args(self) -> List[str]:
+        """Software HEVC encoder options"""
+        return [
+            '-c:v', 'libx265',
+            '-preset', self.hevc_preset,
+            '-tune', self.tune,
+            '-crf', self.hevc_crf,
+            # Wavefront parallel processing encodes CTU rows of a frame concurrently
+            '-x265-params', f'pools={self.threads}:wpp=1:frame-threads={max(1, self.threads // 2)}',
+        ]
+    
+    def _x264_args(self) -> List[str]:
+        """Software H.264 encoder options"""
+        return [
+            '-c:v', 'libx264',
+            '-preset', self.h264_preset,
+            '-tune', self.tune,
+            '-crf', self.h264_crf,
+            '-threads', str(self.threads),
+        ]
+    
+    async def _convert_hevc(self, input_path: str, output_path: str, uploader=None, public_id: Optional[str] = None) -> Dict[str, Any]:
+        """Convert to HEVC (H.265), preferring a hardware encoder"""
+        try:
+            if self.hevc_encoder:
+                encoder, encoder_args = self.hevc_encoder
+                cmd = [
+                    FFMPEG, '-hwaccel', 'auto', '-i', input_path,
+                    '-c:v', encoder, *encoder_args,
+                    '-c:a', 'aac',
+                    '-b:a', '128k',
+                    *self._output_args(output_path)
+                ]
+                result = await self._run_ffmpeg(cmd, output_path, uploader, public_id)
+                if result["success"]:
+                    return result
+                print(f"{encoder} failed, falling back to libx265")
             
-            return False
+            cmd = [
+                FFMPEG, '-i', input_path,
+                *self._x265_args(),
+                '-c:a', 'aac',
+                '-b:a', '128k',
+                *self._output_args(output_path)
+            ]
             
+            return await self._run_ffmpeg(cmd, output_path, uploader, public_id)
+        
         except Exception as e:
             print(f"HEVC conversion failed: {e}")
-            return False
+            return {"success": False, "error": str(e)}
     
-    async def _convert_h264(self, input_path: str, output_path: str) -> bool:
-        """Convert to H.264"""
+    async def _convert_h264(self, input_path: str, output_path: str, uploader=None, public_id: Optional[str] = None) -> Dict[str, Any]:
+        """Convert to H.264, preferring a hardware encoder"""
         try:
+            if self.h264_encoder:
+                encoder, encoder_args = self.h264_encoder
+                cmd = [
+                    FFMPEG, '-hwaccel', 'auto', '-i', input_path,
+                    '-c:v', encoder, *encoder_args,
+                    '-c:a', 'aac',
+                    '-b:a', '128k',
+                    *self._output_args(output_path)
+                ]
+                result = await self._run_ffmpeg(cmd, output_path, uploader, public_id)
+                if result["success"]:
+                    return result
+                print(f"{encoder} failed, falling back to libx264")
+            
             cmd = [
-                'ffmpeg', '-i', input_path,
-                '-c:v', 'libx264',
-                '-preset', 'medium',
-                '-crf', '23',
+                FFMPEG, '-i', input_path,
+                *self._x264_args(),
                 '-c:a', 'aac',
                 '-b:a', '128k',
-                '-movflags', '+faststart',
-                '-y', output_path
+                *self._output_args(output_path)
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode == 0 and os.path.exists(output_path):
-                return await validate_file_with_ffprobe(output_path)
-            
-            return False
-            
+            return await self._run_ffmpeg(cmd, output_path, uploader, public_id)
+        
         except Exception as e:
             print(f"H.264 conversion failed: {e}")
-            return False
+            return {"success": False, "error": str(e)}
     
-    async def _remux(self, input_path: str, output_path: str) -> bool:
+    async def _remux(self, input_path: str, output_path: str, uploader=None, public_id: Optional[str] = None) -> Dict[str, Any]:
         """Remux without re-encoding"""
         try:
             cmd = [
-                'ffmpeg', '-i', input_path,
+                FFMPEG, '-i', input_path,
                 '-c', 'copy',
-                '-movflags', '+faststart',
-                '-y', output_path
+                *self._output_args(output_path)
             ]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode == 0 and os.path.exists(output_path):
-                return await validate_file_with_ffprobe(output_path)
-            
-            return False
-            
+            return await self._run_ffmpeg(cmd, output_path, uploader, public_id)
+        
         except Exception as e:
             print(f"Remux failed: {e}")
-            return False
\ No newline at end of file
+            return {"success": False, "error": str(e)}
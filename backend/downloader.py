@@ -1,62 +1,469 @@
 import asyncio
-import subprocess
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import yt_dlp
 import ffmpeg
 import os
 import random
 import time
 import json
+import re
+import collections
+import copy
+import shutil
+import functools
+import threading
+import contextlib
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from utils import FFPROBE_JSON_CMD, spawn_subprocess, stat_file, usable_hw_encoders, ffmpeg_encoders
+
+# Resolved once with shutil.which, so no PATH search (or which/where subprocess) happens per call
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+
+# Maximum yt-dlp metadata requests in flight across all downloaders
+MAX_CONCURRENT_REQUESTS = int(os.getenv("YTDL_MAX_CONCURRENT", "2"))
+# Maximum yt-dlp downloads in flight; counted separately so long transfers don't hold up quick extractions
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("YTDL_MAX_DOWNLOADS", "2"))
+# Threads for blocking yt-dlp calls, kept apart from the default executor other libraries share.
+# Extractions get their own pool so a hung one can't hold up the quick oEmbed checks in IO_POOL
+EXTRACT_POOL = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix='ytdl-extract')
+IO_POOL = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix='ytdl-io')
+DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix='ytdl-download')
+
+# Each ffmpeg run already uses every core, so only a few conversions run at once; the rest wait their turn
+MAX_CONCURRENT_CONVERSIONS = max(1, (os.cpu_count() or 1) // 2)
+
+# Minimum seconds between yt-dlp requests from all downloaders, plus FAILURE_STEP for each recent failure
+REQUEST_INTERVAL = 5
+REQUEST_INTERVAL_FAILURE_STEP = 10
+
+# Retry waits double from the base on each failure, up to MAX_BACKOFF, plus up to JITTER of randomness
+EXTRACT_BACKOFF_BASE = 30
+DOWNLOAD_BACKOFF_BASE = 60
+MAX_BACKOFF = 600
+BACKOFF_JITTER = 30
+
+# Error classification, matched against the lowercased yt-dlp message;
+# each kind is a named group, so one scan finds every kind present
+ERROR_RE = re.compile(
+    r'(?P<bot>sign in to confirm|not a bot)'
+    r'|(?P<private>private video)'
+    r'|(?P<unavailable>video unavailable)'
+    r'|(?P<removed>removed by the user)'
+    r'|(?P<format>requested format is not available)'
+    r'|http error (?:(?P<forbidden>403)|(?P<not_found>404)|(?P<rate_limited>429))'
+)
+# Kinds that mean the video itself can't be fetched with the current session
+BLOCKED_KINDS = {'bot', 'private', 'unavailable', 'removed'}
+# Errors that mean "try again later" rather than "this will never work"
+RETRYABLE_RE = re.compile(r'rate limit|429|bot|timed out|timeout')
+
+async def _run_command(cmd: List[str], timeout: float) -> Tuple[int, bytes, bytes]:
+    """Run a command to completion without tying up a worker thread
+    
+    The process is killed if it outlives the timeout (asyncio.TimeoutError) or
+    the caller is cancelled.
+    """
+    process = await spawn_subprocess(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stdout, stderr
+
+# Lines of ffmpeg stderr kept for error reports; the rest is read and dropped as it arrives
+FFMPEG_STDERR_TAIL_LINES = 40
+
+async def _run_ffmpeg(cmd: List[str], timeout: float) -> Tuple[int, str]:
+    """Run ffmpeg to completion, returning its exit code and the tail of its stderr
+    
+    stderr is read line by line into a bounded buffer, so a long run with lots
+    of decode warnings never accumulates its whole log in memory.
+    """
+    process = await spawn_subprocess(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    tail = collections.deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+    
+    async def _drain():
+        async for line in process.stderr:
+            tail.append(line)
+        await process.wait()
+    
+    try:
+        await asyncio.wait_for(_drain(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, b''.join(tail).decode(errors='ignore')
+
+def _reported_download(info: Dict[str, Any]) -> Optional[Tuple[Path, int]]:
+    """The file yt-dlp says it wrote for this download, with its size, if it exists"""
+    for download in reversed(info.get('requested_downloads') or []):
+        if download.get('filepath'):
+            try:
+                return Path(download['filepath']), os.stat(download['filepath']).st_size
+            except OSError:
+                return None
+    return None
+
+def _scan_temp_files(temp_dir: Path, task_id: str) -> List[Tuple[Path, int]]:
+    """List a task's temp files with their sizes in a single directory pass"""
+    prefix = f"{task_id}_temp."
+    files = []
+    with os.scandir(temp_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(prefix) and entry.is_file():
+                files.append((Path(entry.path), entry.stat().st_size))
+    return files
+
+def remove_temp_files(temp_dir: Path, task_id: str):
+    """Delete a task's partial downloads (one scandir pass), ignoring files that are already gone"""
+    for temp_file, _ in _scan_temp_files(temp_dir, task_id):
+        try:
+            temp_file.unlink()
+        except:
+            pass
+
+# Files smaller than this always go through ffprobe, whatever their header says
+MIN_SNIFF_SIZE = 100 * 1024
+
+def _has_video_signature(file_path: Path) -> bool:
+    """Check the first bytes for an MP4/MOV, Matroska/WebM or AVI container signature"""
+    try:
+        if file_path.stat().st_size < MIN_SNIFF_SIZE:
+            return False
+        with open(file_path, 'rb') as f:
+            header = f.read(16)
+    except OSError:
+        return False
+    
+    return (header[4:8] == b'ftyp'
+            or header.startswith(b'\x1aE\xdf\xa3')
+            or (header[:4] == b'RIFF' and header[8:12] == b'AVI '))
+
+def _stream_info_from_ydl(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Translate yt-dlp's format fields into the probe_info shape used by convert_to_hevc"""
+    vcodec = info.get('vcodec') or ''
+    acodec = info.get('acodec') or 'none'
+    if vcodec.startswith('avc'):
+        video_codec = 'h264'
+    elif vcodec.startswith(('hvc', 'hev')):
+        video_codec = 'hevc'
+    else:
+        video_codec = vcodec.split('.')[0]
+    
+    if acodec == 'none':
+        audio_codec = None
+    elif acodec.startswith('mp4a'):
+        audio_codec = 'aac'
+    else:
+        audio_codec = acodec.split('.')[0]
+    
+    return {
+        "video_codec": video_codec,
+        "width": info.get('width') or 0,
+        "height": info.get('height') or 0,
+        "audio_codec": audio_codec
+    }
+
+def _backoff(retry_count: int, base: float) -> float:
+    """Exponential backoff with jitter for the given retry number"""
+    return min(MAX_BACKOFF, base * (2 ** retry_count)) + random.uniform(0, BACKOFF_JITTER)
+
+def _error_kinds(error_msg: str) -> set:
+    """Names of the ERROR_RE groups that match anywhere in a yt-dlp error message"""
+    return {m.lastgroup for m in ERROR_RE.finditer(error_msg.lower())}
+
+def _is_retryable(error_msg: str) -> bool:
+    """Whether a yt-dlp error is throttling or a transient network failure"""
+    return RETRYABLE_RE.search(error_msg.lower()) is not None
+
+# Video codecs that already match the conversion target
+REMUXABLE_CODECS = {'h264', 'hevc'}
+
+# Software encoders, tried after the usable hardware encoders of the same codec
+X265_ENCODER = ('libx265', ['-preset', 'faster', '-crf', '23', '-threads', '0'])
+X264_ENCODER = ('libx264', ['-preset', 'medium', '-crf', '23', '-threads', '0'])
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:132.0) Gecko/20100101 Firefox/132.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:132.0) Gecko/20100101 Firefox/132.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.0 Safari/605.1.15'
+]
+
+def _ua_profile(selected_ua: str) -> Tuple[str, Dict[str, str]]:
+    """Build the browser-specific request headers that go with a user agent"""
+    # Enhanced headers that mimic real browser behavior more closely
+    browser_type = 'chrome' if 'chrome' in selected_ua.lower() else 'firefox' if 'firefox' in selected_ua.lower() else 'edge' if 'edge' in selected_ua.lower() else 'safari' if 'safari' in selected_ua.lower() else 'chrome'
+    
+    # Browser-specific headers
+    if browser_type == 'chrome':
+        sec_ch_ua = '"Google Chrome";v="131", "Chromium";v="131", "Not_A Brand";v="24"'
+        sec_ch_ua_platform = '"Windows"'
+    elif browser_type == 'firefox':
+        sec_ch_ua = None
+        sec_ch_ua_platform = None
+    elif browser_type == 'edge':
+        sec_ch_ua = '"Microsoft Edge";v="131", "Chromium";v="131", "Not_A Brand";v="24"'
+        sec_ch_ua_platform = '"Windows"'
+    else:
+        sec_ch_ua = '"Google Chrome";v="131", "Chromium";v="131", "Not_A Brand";v="24"'
+        sec_ch_ua_platform = '"macOS"'
+    
+    headers = {
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+        'Accept-Language': 'en-US,en;q=0.9',
+        'Accept-Encoding': 'gzip, deflate, br, zstd',
+        'Cache-Control': 'max-age=0',
+        'Connection': 'keep-alive',
+        'DNT': '1',
+        'Sec-Fetch-Dest': 'document',
+        'Sec-Fetch-Mode': 'navigate',
+        'Sec-Fetch-Site': 'none',
+        'Sec-Fetch-User': '?1',
+        'Upgrade-Insecure-Requests': '1',
+        'User-Agent': selected_ua,
+    }
+    
+    # Add Chrome-specific headers
+    if sec_ch_ua:
+        headers.update({
+            'sec-ch-ua': sec_ch_ua,
+            'sec-ch-ua-mobile': '?0',
+            'sec-ch-ua-platform': sec_ch_ua_platform,
+        })
+    
+    return selected_ua, headers
+
+# (user agent, headers) pairs, built once instead of on every get_ydl_opts() call
+UA_PROFILES = [_ua_profile(ua) for ua in USER_AGENTS]
+
+# yt-dlp options shared by every request; get_ydl_opts() copies this and adds the per-request parts
+YDL_BASE_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'referer': 'https://www.youtube.com/',
+    # More conservative retry settings to avoid triggering rate limits
+    'sleep_interval': 5,
+    'max_sleep_interval': 15,
+    'sleep_interval_subtitles': 3,
+    'http_chunk_size': 10485760,
+    'extractor_retries': 2,  # Reduced from 3
+    'retries': 3,  # Reduced from 5
+    'fragment_retries': 5,  # Reduced from 10
+    'file_access_retries': 3,  # Reduced from 5
+    'socket_timeout': 45,  # Increased timeout
+    # Additional anti-detection measures
+    'youtube_include_dash_manifest': False,
+    'extract_flat': False,
+    'writethumbnail': False,
+    'writeinfojson': False,
+    'writesubtitles': False,
+    'writeautomaticsub': False,
+    'ignoreerrors': False,
+    'noplaylist': True,
+    'geo_bypass': True,
+    'age_limit': 99,
+    # Additional YouTube-specific options
+    'prefer_insecure': False,
+    'no_check_certificate': False,
+    # Force IPv4 to avoid potential IPv6 issues
+    'force_ipv4': True,
+    # Add random delays to mimic human behavior
+    'playlist_random': True,
+}
+
+# Seconds between the start of successive extract_info_with_fallback strategies
+STRATEGY_STAGGER = 10
+# Wall-clock cap on one metadata extraction; socket_timeout only bounds a single read
+EXTRACT_TIMEOUT = 90
+# socket_timeout for extraction sessions. wait_for can't stop the worker thread, so this is what
+# makes an abandoned extraction give up its session within a few of its requests
+EXTRACT_SOCKET_TIMEOUT = 15
+# Seconds extracted video info is reused for downloading, well inside the lifetime of its signed format URLs
+INFO_CACHE_TTL = 300
+
+# YouTube's oEmbed endpoint answers with ~1KB of JSON, versus several hundred KB for the watch page and player
+OEMBED_URL = 'https://www.youtube.com/oembed'
+OEMBED_TIMEOUT = 10
+YOUTUBE_HOSTS = {'youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtu.be'}
+VIDEO_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+# Path prefixes that are followed by the video ID (youtu.be/<id> has none)
+VIDEO_ID_PATH_PREFIXES = ('/embed/', '/v/', '/shorts/', '/live/')
+
+def _watch_url(url: str) -> Optional[str]:
+    """The canonical https://www.youtube.com/watch?v=<id> form of a YouTube video URL, or None if it has no video ID"""
+    parts = urllib.parse.urlsplit(url)
+    if parts.hostname not in YOUTUBE_HOSTS:
+        return None
+    if parts.hostname == 'youtu.be':
+        video_id = parts.path[1:]
+    elif parts.path == '/watch':
+        video_id = urllib.parse.parse_qs(parts.query).get('v', [''])[0]
+    else:
+        prefix = next((p for p in VIDEO_ID_PATH_PREFIXES if parts.path.startswith(p)), None)
+        video_id = parts.path[len(prefix):] if prefix else ''
+    video_id = video_id.split('/')[0]
+    if not VIDEO_ID_RE.fullmatch(video_id):
+        return None
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def _oembed_status(url: str) -> Optional[int]:
+    """HTTP status of YouTube's oEmbed lookup for a video URL, or None if it couldn't be checked
+    
+    Only a 404 is conclusive: oEmbed also answers 401 for videos that merely
+    have embedding disabled, and those can still be downloaded. The lookup
+    always uses the watch URL, since oEmbed can 404 on other URL forms (e.g.
+    /embed/ or /v/) of videos that exist.
+    """
+    watch_url = _watch_url(url)
+    if watch_url is None:
+        return None
+    query = urllib.parse.urlencode({'url': watch_url, 'format': 'json'})
+    try:
+        with urllib.request.urlopen(f"{OEMBED_URL}?{query}", timeout=OEMBED_TIMEOUT) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return None
+
+@contextlib.contextmanager
+def _session_lock(ydl_lock: threading.Lock):
+    """Hold a cached session's lock, giving up after EXTRACT_TIMEOUT instead of queueing behind a hung extraction"""
+    if not ydl_lock.acquire(timeout=EXTRACT_TIMEOUT):
+        raise Exception("yt-dlp session is still held by an extraction that timed out")
+    try:
+        yield
+    finally:
+        ydl_lock.release()
+
+def _discard_session(ydl: yt_dlp.YoutubeDL, ydl_lock: threading.Lock):
+    """Close a cached YoutubeDL once no extraction is using it, without saving its cookies
+    
+    close() writes the session's cookie jar back to cookies.txt, which would
+    overwrite the file that just replaced it.
+    """
+    with ydl_lock:
+        ydl.params['cookiefile'] = None
+        ydl.close()
+
+# Format selectors for successive download attempts
+FORMAT_SELECTORS = (
+    # First attempt: Prefer MP4 with quality constraints
+    'best[ext=mp4][height<=720]/best[ext=mp4][height<=1080]/best[ext=mp4]/best[height<=720]/best',
+    # Second attempt: Any format, prefer MP4, no height restrictions
+    'best[ext=mp4]/best[vcodec!=none]/best',
+    # Final attempt: Accept any available format
+    'best/worst',
+)
+
+# Options that download_video() layers over get_ydl_opts() on every attempt
+DOWNLOAD_OPTS = {
+    'writesubtitles': False,
+    'writeautomaticsub': False,
+    'ignoreerrors': False,
+    'merge_output_format': 'mp4',  # Force MP4 container when merging
+    'prefer_free_formats': False,  # Don't avoid non-free formats
+    # Enhanced retry settings
+    'retries': 5,
+    'fragment_retries': 10,
+    'file_access_retries': 5,
+    'socket_timeout': 45,
+    'http_chunk_size': 10485760,
+}
+
+@functools.lru_cache(maxsize=1)
+def _detect_browsers_cached():
+    """Detect available browsers for cookie extraction (once per process)"""
+    browsers = []
+    
+    # Common browser executables and their names
+    browser_checks = [
+        ('chrome', ['chrome', 'google-chrome', 'chromium', 'chrome.exe']),
+        ('firefox', ['firefox', 'firefox.exe']),
+        ('edge', ['msedge', 'msedge.exe']),
+        ('safari', ['safari']),
+        ('opera', ['opera', 'opera.exe']),
+    ]
+    
+    for browser_name, executables in browser_checks:
+        # shutil.which searches PATH in-process instead of spawning which/where
+        if any(shutil.which(exe) for exe in executables):
+            browsers.append(browser_name)
+    
+    return browsers
 
 class VideoDownloader:
+    # yt-dlp sessions shared by all downloaders so HTTP connections and TLS sessions are reused;
+    # YoutubeDL isn't thread-safe, so each one comes with a lock
+    _ydl_cache: Dict[tuple, Tuple[yt_dlp.YoutubeDL, threading.Lock]] = {}
+    
+    # Shared across downloaders so concurrent tasks respect one request budget
+    _request_slots = asyncio.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+    _download_slots = asyncio.BoundedSemaphore(MAX_CONCURRENT_DOWNLOADS)
+    _request_lock = asyncio.Lock()
+    _last_request_ts = 0.0
+    _convert_slots = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
+    
+    # Bumped by cookies_replaced(); part of each cached session's key. yt-dlp rewrites cookies.txt
+    # itself whenever a session closes, so its mtime can't tell an upload apart
+    _cookies_generation = 0
+    
+    # ((mtime_ns, size), result) of the last validate_cookies_file() parse
+    _cookies_cache: Optional[Tuple[Tuple[int, int], dict]] = None
+    
+    # url -> (extraction time, info), so download_video doesn't extract the same video again
+    _info_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+    
     def __init__(self):
         self.cookies_file = Path("cookies.txt")
-        self.user_agents = [
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:132.0) Gecko/20100101 Firefox/132.0',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:132.0) Gecko/20100101 Firefox/132.0',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.0 Safari/605.1.15'
-        ]
+        self.user_agents = USER_AGENTS
+        self._ua_profiles = UA_PROFILES
         # Track failed attempts for rate limiting
         self.failed_attempts = 0
-        self.last_attempt_time = 0
         # Try to detect browser installation for cookie extraction
-        self.detected_browsers = self._detect_browsers()
+        self.detected_browsers = _detect_browsers_cached()
+        # Stream info of files checked by validate_video_file, keyed by path
+        self.probe_info: Dict[str, Dict[str, Any]] = {}
+        # Encoders this ffmpeg build has; if detection failed, assume just the software ones
+        available_encoders = ffmpeg_encoders() or 'libx265 libx264'
+        self.have_x265 = 'libx265' in available_encoders
+        self.have_x264 = 'libx264' in available_encoders
+        # Hardware encoders that passed a trial encode; main.py runs the trials at startup
+        hevc_hw, h264_hw = usable_hw_encoders()
+        self.hevc_encoders = [*hevc_hw, *([X265_ENCODER] if self.have_x265 else [])]
+        # libx265 doesn't fail for lack of hardware, so H.264 is only needed when it's missing
+        self.h264_encoders = [] if self.have_x265 else [*h264_hw, *([X264_ENCODER] if self.have_x264 else [])]
     
-    def _detect_browsers(self):
-        """Detect available browsers for cookie extraction"""
-        browsers = []
-        
-        # Common browser executables and their names
-        browser_checks = [
-            ('chrome', ['chrome', 'google-chrome', 'chromium', 'chrome.exe']),
-            ('firefox', ['firefox', 'firefox.exe']),
-            ('edge', ['msedge', 'msedge.exe']),
-            ('safari', ['safari']),
-            ('opera', ['opera', 'opera.exe']),
-        ]
-        
-        for browser_name, executables in browser_checks:
-            for exe in executables:
-                try:
-                    # Try to find the executable
-                    result = subprocess.run(['where' if os.name == 'nt' else 'which', exe], 
-                                          capture_output=True, text=True, timeout=5)
-                    if result.returncode == 0:
-                        browsers.append(browser_name)
-                        break
-                except:
-                    continue
-        
-        return browsers
+    def _cookies_stat(self) -> Optional[os.stat_result]:
+        """stat() cookies.txt, or None if it doesn't exist"""
+        try:
+            return self.cookies_file.stat()
+        except OSError:
+            return None
     
     def validate_cookies_file(self) -> dict:
         """Validate the cookies.txt file and return status info"""
-        if not self.cookies_file.exists():
+        st = self._cookies_stat()
+        if st is None:
             return {
                 "valid": False,
                 "error": "cookies.txt file not found",
@@ -64,10 +471,21 @@ class VideoDownloader:
                 "line_count": 0
             }
         
+        # Only re-parse when the file has actually changed
+        key = (st.st_mtime_ns, st.st_size)
+        if self._cookies_cache and self._cookies_cache[0] == key:
+            return self._cookies_cache[1]
+        
+        result = self._parse_cookies_file()
+        VideoDownloader._cookies_cache = (key, result)
+        return result
+    
+    def _parse_cookies_file(self) -> dict:
+        """Read cookies.txt and check it for Netscape-format YouTube cookies"""
         try:
             with open(self.cookies_file, 'r', encoding='utf-8') as f:
                 content = f.read()
-                lines = content.strip().split('\n')
+                lines = content.strip().splitlines()
                 
             # Basic validation
             if not content.strip():
@@ -78,22 +496,11 @@ class VideoDownloader:
                     "line_count": 0
                 }
             
-            # Check for Netscape format indicators
-            valid_lines = 0
-            youtube_cookies = 0
-            
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                
-                # Split by tabs (Netscape format)
-                parts = line.split('\t')
-                if len(parts) >= 6:
-                    valid_lines += 1
-                    # Check if it's a YouTube cookie
-                    if '.youtube.com' in parts[0] or 'youtube.com' in parts[0]:
-                        youtube_cookies += 1
+            # Check for Netscape format indicators: tab-separated rows with at least 6 fields
+            rows = [line.split('\t') for line in lines if line and not line.startswith('#')]
+            domains = [row[0] for row in rows if len(row) >= 6]
+            valid_lines = len(domains)
+            youtube_cookies = sum(1 for domain in domains if 'youtube.com' in domain)
             
             if valid_lines == 0:
                 return {
@@ -128,103 +535,74 @@ class VideoDownloader:
                 "line_count": 0
             }
     
-    def get_ydl_opts(self, download=True, use_browser_cookies=False):
-        """Get yt-dlp options with enhanced anti-detection measures"""
-        # Much more aggressive delay based on failed attempts
-        base_delay = 5 + (self.failed_attempts * 10)  # Start with 5s, increase by 10s each failure
-        current_time = time.time()
-        if current_time - self.last_attempt_time < base_delay:
-            sleep_time = base_delay - (current_time - self.last_attempt_time)
-            print(f"Rate limiting: sleeping for {sleep_time:.1f} seconds...")
-            time.sleep(sleep_time)
+    async def _rate_limit(self):
+        """Enforce a minimum interval between yt-dlp requests from all downloaders"""
+        # The first request goes straight through; later ones are spaced out, more so after failures
+        min_interval = REQUEST_INTERVAL + self.failed_attempts * REQUEST_INTERVAL_FAILURE_STEP
+        async with self._request_lock:
+            sleep_time = min_interval - (time.monotonic() - VideoDownloader._last_request_ts)
+            if sleep_time > 0:
+                print(f"Rate limiting: sleeping for {sleep_time:.1f} seconds...")
+                await asyncio.sleep(sleep_time)
+            VideoDownloader._last_request_ts = time.monotonic()
+    
+    @classmethod
+    def cookies_replaced(cls):
+        """Note that /upload-cookies wrote a new cookies.txt, so cached sessions must reload it"""
+        cls._cookies_generation += 1
+    
+    def _get_ydl(self, ydl_opts: dict, *key) -> Tuple[yt_dlp.YoutubeDL, threading.Lock]:
+        """Return the cached YoutubeDL for this key, building it from ydl_opts on first use
         
-        # Select a random user agent
-        selected_ua = random.choice(self.user_agents)
+        A reused session keeps the user agent it was built with. Sessions are
+        rebuilt after a cookies upload, since yt-dlp loads cookies.txt only once.
+        """
+        generation = self._cookies_generation
         
-        # Enhanced headers that mimic real browser behavior more closely
-        browser_type = 'chrome' if 'chrome' in selected_ua.lower() else 'firefox' if 'firefox' in selected_ua.lower() else 'edge' if 'edge' in selected_ua.lower() else 'safari' if 'safari' in selected_ua.lower() else 'chrome'
+        if (*key, generation) not in self._ydl_cache:
+            # Drop sessions holding cookies from before the last upload
+            for stale in [k for k in self._ydl_cache if k[:-1] == key]:
+                ydl, ydl_lock = self._ydl_cache.pop(stale)
+                asyncio.get_running_loop().run_in_executor(None, _discard_session, ydl, ydl_lock)
+            self._ydl_cache[(*key, generation)] = (yt_dlp.YoutubeDL(ydl_opts), threading.Lock())
         
-        # Browser-specific headers
-        if browser_type == 'chrome':
-            sec_ch_ua = '"Google Chrome";v="131", "Chromium";v="131", "Not_A Brand";v="24"'
-            sec_ch_ua_platform = '"Windows"'
-        elif browser_type == 'firefox':
-            sec_ch_ua = None
-            sec_ch_ua_platform = None
-        elif browser_type == 'edge':
-            sec_ch_ua = '"Microsoft Edge";v="131", "Chromium";v="131", "Not_A Brand";v="24"'
-            sec_ch_ua_platform = '"Windows"'
-        else:
-            sec_ch_ua = '"Google Chrome";v="131", "Chromium";v="131", "Not_A Brand";v="24"'
-            sec_ch_ua_platform = '"macOS"'
-
-        headers = {
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Accept-Encoding': 'gzip, deflate, br, zstd',
-            'Cache-Control': 'max-age=0',
-            'Connection': 'keep-alive',
-            'DNT': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'Sec-Fetch-User': '?1',
-            'Upgrade-Insecure-Requests': '1',
-            'User-Agent': selected_ua,
-        }
+        return self._ydl_cache[(*key, generation)]
+    
+    def _remember_info(self, url: str, info: Optional[Dict[str, Any]]):
+        """Keep extracted info for download_video, dropping entries that have expired"""
+        now = time.monotonic()
+        for stale in [u for u, (ts, _) in self._info_cache.items() if now - ts > INFO_CACHE_TTL]:
+            del self._info_cache[stale]
+        if info:
+            self._info_cache[url] = (now, info)
+    
+    def _cached_info(self, url: str) -> Optional[Dict[str, Any]]:
+        """Info extracted for this URL within the last INFO_CACHE_TTL seconds, if any"""
+        cached = self._info_cache.get(url)
+        if cached and time.monotonic() - cached[0] <= INFO_CACHE_TTL:
+            return cached[1]
+        return None
+    
+    def get_ydl_opts(self, download=True, use_browser_cookies=False, ua_profile=None):
+        """Get yt-dlp options with enhanced anti-detection measures
         
-        # Add Chrome-specific headers
-        if sec_ch_ua:
-            headers.update({
-                'sec-ch-ua': sec_ch_ua,
-                'sec-ch-ua-mobile': '?0',
-                'sec-ch-ua-platform': sec_ch_ua_platform,
-            })
-
-        opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'user_agent': selected_ua,
-            'referer': 'https://www.youtube.com/',
-            'headers': headers,
-            # More conservative retry settings to avoid triggering rate limits
-            'sleep_interval': 5,
-            'max_sleep_interval': 15,
-            'sleep_interval_subtitles': 3,
-            'http_chunk_size': 10485760,
-            'extractor_retries': 2,  # Reduced from 3
-            'retries': 3,  # Reduced from 5
-            'fragment_retries': 5,  # Reduced from 10
-            'file_access_retries': 3,  # Reduced from 5
-            'socket_timeout': 45,  # Increased timeout
-            # Additional anti-detection measures
-            'youtube_include_dash_manifest': False,
-            'extract_flat': False,
-            'writethumbnail': False,
-            'writeinfojson': False,
-            'writesubtitles': False,
-            'writeautomaticsub': False,
-            'ignoreerrors': False,
-            'noplaylist': True,
-            'geo_bypass': True,
-            'age_limit': 99,
-            # Additional YouTube-specific options
-            'prefer_insecure': False,
-            'no_check_certificate': False,
-            # Force IPv4 to avoid potential IPv6 issues
-            'force_ipv4': True,
-            # Add random delays to mimic human behavior
-            'playlist_random': True,
-        }
+        ua_profile is a (user agent, headers) pair from UA_PROFILES; a random
+        one is picked when it isn't given.
+        """
+        # Select a random user agent along with its prebuilt headers
+        selected_ua, headers = ua_profile or random.choice(self._ua_profiles)
+        
+        opts = {**YDL_BASE_OPTS, 'user_agent': selected_ua, 'headers': headers}
         
         if not download:
             opts['skip_download'] = True
+            opts['socket_timeout'] = EXTRACT_SOCKET_TIMEOUT
         
         # Cookie handling priority:
         # 1. Browser cookies (if requested and available)
         # 2. Uploaded cookies.txt file
         # 3. No cookies (fallback)
+        cookies_stat = self._cookies_stat()
         
         if use_browser_cookies and self.detected_browsers:
             # Try to use browser cookies - Chrome first, then others
@@ -237,7 +615,7 @@ class VideoDownloader:
                         break
                     except:
                         continue
-        elif self.cookies_file.exists() and self.cookies_file.stat().st_size > 0:
+        elif cookies_stat is not None and cookies_stat.st_size > 0:
             opts['cookiefile'] = str(self.cookies_file)
             print(f"Using cookies from file: {self.cookies_file}")
         else:
@@ -250,36 +628,37 @@ class VideoDownloader:
         max_retries = 3
         retry_count = 0
         
+        # Deleted or mistyped videos fail here without spending a rate-limited yt-dlp request
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(IO_POOL, _oembed_status, url) == 404:
+            raise Exception("Video not found - it may have been deleted or made private")
+        
         while retry_count < max_retries:
             try:
                 # Try browser cookies first, then file cookies
                 use_browser_cookies = retry_count == 0 and self.detected_browsers
                 ydl_opts = self.get_ydl_opts(download=False, use_browser_cookies=use_browser_cookies)
                 
+                ydl, ydl_lock = self._get_ydl(ydl_opts, 'extract', bool(use_browser_cookies))
+                
                 def _extract():
                     try:
-                        # Much longer delays to avoid rate limiting - mimic very slow human behavior
-                        delay = random.uniform(10, 20) + (retry_count * 10)  # 10-20s base, +10s per retry
-                        print(f"Waiting {delay:.1f} seconds before extraction attempt...")
-                        time.sleep(delay)
-                        
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                        with _session_lock(ydl_lock):
                             return ydl.extract_info(url, download=False)
                     except yt_dlp.utils.DownloadError as e:
                         error_msg = str(e)
                         print(f"yt-dlp extract error (attempt {retry_count + 1}): {error_msg}")
                         
+                        kinds = _error_kinds(error_msg)
+                        
                         # Check for specific YouTube blocking patterns
-                        if any(phrase in error_msg.lower() for phrase in [
-                            'sign in to confirm', 'not a bot', 'private video', 
-                            'video unavailable', 'removed by the user'
-                        ]):
+                        if kinds & BLOCKED_KINDS:
                             raise Exception(f"Video access blocked: {error_msg}")
-                        elif 'http error 403' in error_msg.lower():
+                        elif 'forbidden' in kinds:
                             raise Exception("Access forbidden - video may be region-locked or require authentication")
-                        elif 'http error 404' in error_msg.lower():
+                        elif 'not_found' in kinds:
                             raise Exception("Video not found - it may have been deleted or made private")
-                        elif 'http error 429' in error_msg.lower():
+                        elif 'rate_limited' in kinds:
                             # Rate limited - will retry
                             raise yt_dlp.utils.DownloadError("Rate limited")
                         else:
@@ -289,24 +668,29 @@ class VideoDownloader:
                         raise Exception(f"Could not extract video information: {str(e)}")
                 
                 # Run in thread pool to avoid blocking
-                loop = asyncio.get_event_loop()
-                info = await loop.run_in_executor(None, _extract)
+                loop = asyncio.get_running_loop()
+                async with self._request_slots:
+                    await self._rate_limit()
+                    try:
+                        info = await asyncio.wait_for(loop.run_in_executor(EXTRACT_POOL, _extract), EXTRACT_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        raise Exception(f"Extraction timed out after {EXTRACT_TIMEOUT}s")
                 
                 # Success - reset failed attempts
                 self.failed_attempts = 0
+                self._remember_info(url, info)
                 return info
                 
             except Exception as e:
                 retry_count += 1
                 self.failed_attempts += 1
-                self.last_attempt_time = time.time()
                 
                 error_msg = str(e)
                 print(f"Extract info error (attempt {retry_count}): {error_msg}")
                 
                 # If rate limited or bot detection, wait much longer before retry
-                if retry_count < max_retries and ('rate limited' in error_msg.lower() or 'bot' in error_msg.lower()):
-                    wait_time = random.uniform(30, 60) + (retry_count * 30)  # 30-60s base, +30s per retry
+                if retry_count < max_retries and _is_retryable(error_msg):
+                    wait_time = _backoff(retry_count, EXTRACT_BACKOFF_BASE)
                     print(f"Anti-bot detection triggered. Waiting {wait_time:.1f} seconds before retry...")
                     await asyncio.sleep(wait_time)
                     continue
@@ -319,7 +703,7 @@ class VideoDownloader:
     async def download_video(self, url: str, task_id: str) -> Optional[Path]:
         """Download video using yt-dlp with enhanced error handling"""
         temp_dir = Path("temp")
-        temp_dir.mkdir(exist_ok=True)
+        await asyncio.to_thread(temp_dir.mkdir, exist_ok=True)
         
         output_template = str(temp_dir / f"{task_id}_temp.%(ext)s")
         max_retries = 3
@@ -329,73 +713,61 @@ class VideoDownloader:
             try:
                 # Try browser cookies first, then file cookies
                 use_browser_cookies = retry_count == 0 and self.detected_browsers
-                ydl_opts = self.get_ydl_opts(download=True, use_browser_cookies=use_browser_cookies)
-                
                 # Progressive format fallback strategy
-                if retry_count == 0:
-                    # First attempt: Prefer MP4 with quality constraints
-                    format_selector = 'best[ext=mp4][height<=720]/best[ext=mp4][height<=1080]/best[ext=mp4]/best[height<=720]/best'
-                elif retry_count == 1:
-                    # Second attempt: Any format, prefer MP4, no height restrictions
-                    format_selector = 'best[ext=mp4]/best[vcodec!=none]/best'
-                else:
-                    # Final attempt: Accept any available format
-                    format_selector = 'best/worst'
-                
+                format_selector = FORMAT_SELECTORS[min(retry_count, len(FORMAT_SELECTORS) - 1)]
                 print(f"Download attempt {retry_count + 1}: Using format selector: {format_selector}")
                 
-                ydl_opts.update({
+                ydl_opts = {
+                    **self.get_ydl_opts(download=True, use_browser_cookies=use_browser_cookies),
+                    **DOWNLOAD_OPTS,
                     'format': format_selector,
                     'outtmpl': output_template,
-                    'writesubtitles': False,
-                    'writeautomaticsub': False,
-                    'ignoreerrors': False,
-                    'merge_output_format': 'mp4',  # Force MP4 container when merging
-                    'prefer_free_formats': False,  # Don't avoid non-free formats
-                    # Enhanced retry settings
-                    'retries': 5,
-                    'fragment_retries': 10,
-                    'file_access_retries': 5,
-                    'socket_timeout': 45,
-                    'http_chunk_size': 10485760,
-                })
+                }
+                
+                info = self._cached_info(url)
+                generation = self._cookies_generation
                 
                 def _download():
                     try:
-                        # Much longer delay for downloads - critical to avoid detection
-                        delay = random.uniform(15, 30) + (retry_count * 15)  # 15-30s base, +15s per retry
-                        print(f"Waiting {delay:.1f} seconds before download attempt...")
-                        time.sleep(delay)
-                        
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            ydl.download([url])
-                            return True
+                        ydl = yt_dlp.YoutubeDL(ydl_opts)
+                        try:
+                            if info:
+                                # Select and fetch formats from the info we already have, without asking YouTube again;
+                                # yt-dlp modifies the dict it's given, so each attempt gets its own copy
+                                return ydl.process_ie_result(copy.deepcopy(info), download=True)
+                            # Same as ydl.download([url]), but keeps the info of the format that was fetched
+                            return ydl.extract_info(url, download=True)
+                        finally:
+                            # close() saves the cookie jar; don't write it over cookies uploaded mid-download
+                            if self._cookies_generation != generation:
+                                ydl.params['cookiefile'] = None
+                            ydl.close()
                     except yt_dlp.utils.DownloadError as e:
                         error_msg = str(e)
                         print(f"yt-dlp download error (attempt {retry_count + 1}): {error_msg}")
                         
+                        kinds = _error_kinds(error_msg)
+                        
                         # Provide specific error messages
-                        if any(phrase in error_msg.lower() for phrase in [
-                            'sign in to confirm', 'not a bot'
-                        ]):
+                        if 'bot' in kinds:
                             raise Exception("YouTube is blocking automated access. Please try uploading cookies.txt file or try again later.")
-                        elif 'requested format is not available' in error_msg.lower():
+                        elif 'format' in kinds:
                             # Format selection issue - will retry with different strategy
                             if retry_count < max_retries - 1:
                                 print(f"Format not available, will retry with different strategy...")
                                 raise yt_dlp.utils.DownloadError("Format not available")
                             else:
                                 raise Exception("Video format not available. The video may have limited quality options or be unavailable for download.")
-                        elif 'http error 403' in error_msg.lower():
+                        elif 'forbidden' in kinds:
                             raise Exception("Access forbidden. Video may be region-locked, private, or require authentication. Try uploading cookies.txt.")
-                        elif 'http error 404' in error_msg.lower():
+                        elif 'not_found' in kinds:
                             raise Exception("Video not found. It may have been deleted, made private, or the URL is incorrect.")
-                        elif 'http error 429' in error_msg.lower():
+                        elif 'rate_limited' in kinds:
                             # Rate limited - will retry
                             raise yt_dlp.utils.DownloadError("Rate limited")
-                        elif 'private video' in error_msg.lower():
+                        elif 'private' in kinds:
                             raise Exception("This is a private video. You need to upload cookies.txt from a logged-in session.")
-                        elif 'video unavailable' in error_msg.lower():
+                        elif 'unavailable' in kinds:
                             raise Exception("Video is unavailable. It may be region-locked or removed.")
                         else:
                             raise Exception(f"Download failed: {error_msg}")
@@ -404,27 +776,35 @@ class VideoDownloader:
                         raise Exception(f"Download failed: {str(e)}")
                 
                 # Run in thread pool
-                loop = asyncio.get_event_loop()
-                success = await loop.run_in_executor(None, _download)
+                loop = asyncio.get_running_loop()
+                async with self._download_slots:
+                    await self._rate_limit()
+                    downloaded_info = await loop.run_in_executor(DOWNLOAD_POOL, _download)
                 
-                if not success:
+                if not downloaded_info:
                     raise Exception("Download failed - unknown error")
                 
-                # Find the downloaded file
-                downloaded_files = list(temp_dir.glob(f"{task_id}_temp.*"))
-                if not downloaded_files:
-                    raise Exception("Download completed but no file was created")
-                
-                # Get the largest file (in case multiple formats were downloaded)
-                downloaded_file = max(downloaded_files, key=lambda f: f.stat().st_size)
+                # yt-dlp reports where it put the final (merged) file; only scan temp_dir if it didn't
+                downloaded = await asyncio.to_thread(_reported_download, downloaded_info)
+                if downloaded is None:
+                    downloaded_files = await asyncio.to_thread(_scan_temp_files, temp_dir, task_id)
+                    if not downloaded_files:
+                        raise Exception("Download completed but no file was created")
+                    
+                    # Get the largest file (in case multiple formats were downloaded)
+                    downloaded = max(downloaded_files, key=lambda f: f[1])
+                downloaded_file, downloaded_size = downloaded
                 
-                if downloaded_file.stat().st_size == 0:
+                if downloaded_size == 0:
                     raise Exception("Downloaded file is empty")
                 
                 # Validate the file is a proper video file
                 if not await self.validate_video_file(downloaded_file):
                     raise Exception("Downloaded file is not a valid video file")
                 
+                # The signature check skips ffprobe, so take the stream info from yt-dlp instead
+                self.probe_info.setdefault(str(downloaded_file), _stream_info_from_ydl(downloaded_info))
+                
                 # Success - reset failed attempts
                 self.failed_attempts = 0
                 return downloaded_file
@@ -432,21 +812,16 @@ class VideoDownloader:
             except Exception as e:
                 retry_count += 1
                 self.failed_attempts += 1
-                self.last_attempt_time = time.time()
                 
                 error_msg = str(e)
                 print(f"Download error (attempt {retry_count}): {error_msg}")
                 
                 # Clean up any partial downloads
-                for temp_file in temp_dir.glob(f"{task_id}_temp.*"):
-                    try:
-                        temp_file.unlink()
-                    except:
-                        pass
+                await asyncio.to_thread(remove_temp_files, temp_dir, task_id)
                 
                 # If rate limited or bot detection, wait much longer before retry
-                if retry_count < max_retries and ('rate limited' in error_msg.lower() or 'bot' in error_msg.lower()):
-                    wait_time = random.uniform(60, 120) + (retry_count * 60)  # 1-2min base, +1min per retry
+                if retry_count < max_retries and _is_retryable(error_msg):
+                    wait_time = _backoff(retry_count, DOWNLOAD_BACKOFF_BASE)
                     print(f"Download blocked by anti-bot. Waiting {wait_time:.1f} seconds before retry...")
                     await asyncio.sleep(wait_time)
                     continue
@@ -457,160 +832,133 @@ class VideoDownloader:
         raise Exception("Max retries exceeded")
     
     async def validate_video_file(self, file_path: Path) -> bool:
-        """Validate that the file is a proper video file using ffprobe"""
-        def _validate():
-            try:
-                result = subprocess.run([
-                    'ffprobe', '-v', 'quiet', '-print_format', 'json',
-                    '-show_format', '-show_streams', str(file_path)
-                ], capture_output=True, text=True, timeout=30)
-                
-                if result.returncode != 0:
-                    print(f"ffprobe failed: {result.stderr}")
-                    return False
-                
-                # Parse the JSON output
-                probe_data = json.loads(result.stdout)
-                
-                # Check if we have video streams
-                video_streams = [s for s in probe_data.get('streams', []) if s.get('codec_type') == 'video']
-                if not video_streams:
-                    print("No video streams found in file")
-                    return False
-                
-                # Check if format is recognized
-                format_info = probe_data.get('format', {})
-                if not format_info.get('format_name'):
-                    print("Unknown format")
-                    return False
-                
-                print(f"Video validation successful: {format_info.get('format_name')}")
-                return True
-                
-            except subprocess.TimeoutExpired:
-                print("Video validation timed out")
+        """Validate that the file is a proper video file, using ffprobe unless its signature is conclusive"""
+        # stat() and the header read are blocking, so keep them off the event loop
+        if await asyncio.to_thread(_has_video_signature, file_path):
+            print("Video validation successful: container signature")
+            return True
+        
+        try:
+            returncode, stdout, stderr = await _run_command([*FFPROBE_JSON_CMD, str(file_path)], timeout=30)
+            
+            if returncode != 0:
+                print(f"ffprobe failed: {stderr.decode(errors='ignore')}")
                 return False
-            except json.JSONDecodeError:
-                print("Failed to parse ffprobe output")
+            
+            # Parse the JSON output
+            probe_data = json.loads(stdout)
+            
+            # Check if we have video streams
+            video_streams = [s for s in probe_data.get('streams', []) if s.get('codec_type') == 'video']
+            if not video_streams:
+                print("No video streams found in file")
                 return False
-            except Exception as e:
-                print(f"Video validation error: {e}")
+            
+            # Check if format is recognized
+            format_info = probe_data.get('format', {})
+            if not format_info.get('format_name'):
+                print("Unknown format")
                 return False
-        
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, _validate)
+            
+            print(f"Video validation successful: {format_info.get('format_name')}")
+            
+            # Keep the stream info so convert_to_hevc can decide whether a remux is enough
+            audio_streams = [s for s in probe_data.get('streams', []) if s.get('codec_type') == 'audio']
+            self.probe_info[str(file_path)] = {
+                "video_codec": video_streams[0].get('codec_name'),
+                "width": video_streams[0].get('width') or 0,
+                "height": video_streams[0].get('height') or 0,
+                "audio_codec": audio_streams[0].get('codec_name') if audio_streams else None
+            }
+            return True
+            
+        except asyncio.TimeoutError:
+            print("Video validation timed out")
+            return False
+        except json.JSONDecodeError:
+            print("Failed to parse ffprobe output")
+            return False
+        except Exception as e:
+            print(f"Video validation error: {e}")
+            return False
     
     async def convert_to_hevc(self, input_file: Path, output_file: Path):
         """Convert video to HEVC using ffmpeg with better error handling"""
-        def _convert():
-            try:
-                # First, validate input file again
-                probe_result = subprocess.run([
-                    'ffprobe', '-v', 'quiet', '-print_format', 'json', 
-                    '-show_format', '-show_streams', str(input_file)
-                ], capture_output=True, text=True, timeout=30)
-                
-                if probe_result.returncode != 0:
-                    print(f"Input file validation failed: {probe_result.stderr}")
-                    raise Exception("Input file is corrupted or invalid")
-                
-                # Parse probe data to get video info
-                try:
-                    probe_data = json.loads(probe_result.stdout)
-                    video_streams = [s for s in probe_data.get('streams', []) if s.get('codec_type') == 'video']
-                    if not video_streams:
-                        raise Exception("No video streams found in input file")
+        
+        # Inputs that already meet the 720p H.264/HEVC + AAC target only need their container rewritten
+        info = self.probe_info.get(str(input_file))
+        fits_720p = bool(info and 0 < info["width"] <= 1280 and 0 < info["height"] <= 720)
+        remux_first = (fits_720p
+                       and info["video_codec"] in REMUXABLE_CODECS
+                       and info["audio_codec"] in (None, 'aac'))
+        # Scaling and padding every frame is only needed for inputs larger than 720p (or of unknown size)
+        scale_args = [] if fits_720p else ['-vf', 'scale=1280:720:force_original_aspect_ratio=decrease,pad=1280:720:(ow-iw)/2:(oh-ih)/2']
+        
+        # -v error keeps stderr down to the actual error messages instead of the full encode log
+        copy_cmd = [
+            FFMPEG, '-v', 'error', '-i', str(input_file),
+            '-c', 'copy',
+            '-movflags', 'faststart',
+            '-avoid_negative_ts', 'make_zero',
+            '-y',
+            str(output_file)
+        ]
+        
+        async def _run(cmd, timeout) -> Tuple[bool, str]:
+            returncode, stderr = await _run_ffmpeg(cmd, timeout)
+            st = await stat_file(str(output_file))
+            return returncode == 0 and st is not None and st.st_size > 0, stderr
+        
+        try:
+            async with self._convert_slots:
+                # download_video already validated the input; ffmpeg fails fast on anything it can't read
+                if remux_first:
+                    print(f"Input is already {info['video_codec']} {info['width']}x{info['height']}, remuxing...")
+                    success, _ = await _run(copy_cmd, timeout=600)
+                    if success:
+                        print("Remux successful")
+                        return
                     
-                    print(f"Input video info: {video_streams[0].get('codec_name', 'unknown')} "
-                          f"{video_streams[0].get('width', '?')}x{video_streams[0].get('height', '?')}")
-                except:
-                    print("Could not parse video info, proceeding anyway...")
-                
-                # Try HEVC conversion first
-                hevc_cmd = [
-                    'ffmpeg', '-i', str(input_file),
-                    '-c:v', 'libx265',
-                    '-c:a', 'aac',
-                    '-b:a', '96k',
-                    '-vf', 'scale=1280:720:force_original_aspect_ratio=decrease,pad=1280:720:(ow-iw)/2:(oh-ih)/2',
-                    '-preset', 'medium',
-                    '-crf', '23',
-                    '-movflags', 'faststart',
-                    '-avoid_negative_ts', 'make_zero',
-                    '-fflags', '+genpts',
-                    '-y',  # Overwrite output file
-                    str(output_file)
-                ]
-                
-                print("Starting HEVC conversion...")
-                result = subprocess.run(hevc_cmd, capture_output=True, text=True, timeout=1800)
-                
-                if result.returncode == 0 and output_file.exists() and output_file.stat().st_size > 0:
-                    print("HEVC conversion successful")
-                    return True
-                
-                # If HEVC fails, try H.264
-                print("HEVC conversion failed, trying H.264...")
-                h264_cmd = [
-                    'ffmpeg', '-i', str(input_file),
-                    '-c:v', 'libx264',
-                    '-c:a', 'aac',
-                    '-b:a', '96k',
-                    '-vf', 'scale=1280:720:force_original_aspect_ratio=decrease,pad=1280:720:(ow-iw)/2:(oh-ih)/2',
-                    '-preset', 'medium',
-                    '-crf', '23',
-                    '-movflags', 'faststart',
-                    '-avoid_negative_ts', 'make_zero',
-                    '-fflags', '+genpts',
-                    '-y',
-                    str(output_file)
-                ]
-                
-                result = subprocess.run(h264_cmd, capture_output=True, text=True, timeout=1800)
+                    print("Remux failed, re-encoding instead...")
                 
-                if result.returncode == 0 and output_file.exists() and output_file.stat().st_size > 0:
-                    print("H.264 conversion successful")
-                    return True
+                # Hardware encoders first, then the software encoder of the same codec
+                for codec_name, encoders in (('HEVC', self.hevc_encoders), ('H.264', self.h264_encoders)):
+                    for encoder, encoder_args in encoders:
+                        cmd = [
+                            FFMPEG, '-v', 'error', '-i', str(input_file),
+                            '-c:v', encoder, *encoder_args,
+                            '-c:a', 'aac',
+                            '-b:a', '96k',
+                            *scale_args,
+                            '-movflags', 'faststart',
+                            '-avoid_negative_ts', 'make_zero',
+                            '-fflags', '+genpts',
+                            '-y',  # Overwrite output file
+                            str(output_file)
+                        ]
+                        
+                        print(f"Starting {codec_name} conversion with {encoder}...")
+                        success, _ = await _run(cmd, timeout=1800)
+                        if success:
+                            print(f"{codec_name} conversion successful")
+                            return
+                        
+                        print(f"{encoder} conversion failed, trying next encoder...")
                 
                 # If both fail, try simple copy with container change
                 print("Both encoders failed, trying simple remux...")
-                copy_cmd = [
-                    'ffmpeg', '-i', str(input_file),
-                    '-c', 'copy',
-                    '-movflags', 'faststart',
-                    '-avoid_negative_ts', 'make_zero',
-                    '-y',
-                    str(output_file)
-                ]
-                
-                result = subprocess.run(copy_cmd, capture_output=True, text=True, timeout=600)
-                
-                if result.returncode == 0 and output_file.exists() and output_file.stat().st_size > 0:
+                success, stderr = await _run(copy_cmd, timeout=600)
+                if success:
                     print("Simple remux successful")
-                    return True
-                
-                # If everything fails, provide detailed error
-                error_msg = result.stderr if result.stderr else "Unknown conversion error"
-                print(f"All conversion attempts failed. Last error: {error_msg}")
-                raise Exception(f"Video conversion failed: {error_msg}")
-                
-            except subprocess.TimeoutExpired:
-                raise Exception("Video conversion timed out (file too large or processing issue)")
-            except Exception as e:
-                print(f"Conversion error: {e}")
-                raise Exception(f"Video conversion failed: {str(e)}")
-        
-        # Run in thread pool
-        loop = asyncio.get_event_loop()
-        try:
-            success = await loop.run_in_executor(None, _convert)
-            if not success:
-                raise Exception("Video conversion failed")
+                    return
             
-            # Final validation of output file
-            if not await self.validate_video_file(output_file):
-                raise Exception("Converted file is not valid")
-                
+            # If everything fails, provide detailed error
+            error_msg = stderr if stderr else "Unknown conversion error"
+            print(f"All conversion attempts failed. Last error: {error_msg}")
+            raise Exception(f"Video conversion failed: {error_msg}")
+            
+        except asyncio.TimeoutError:
+            raise Exception("Video conversion timed out (file too large or processing issue)")
         except Exception as e:
             print(f"Conversion error: {e}")
             raise
@@ -634,50 +982,79 @@ class VideoDownloader:
             {'name': 'minimal', 'opts': {'extract_flat': False, 'youtube_include_dash_manifest': False}},
         ]
         
+        # One browser identity for the URL; it only needs to vary between requests, not strategies
+        ua_profile = random.choice(self._ua_profiles)
+        
+        # Strategies start STRATEGY_STAGGER seconds apart and the first success wins;
+        # the request semaphore and rate limiter still space out the actual yt-dlp calls
+        tasks = [
+            asyncio.create_task(self._run_strategy(url, strategy, i * STRATEGY_STAGGER, ua_profile))
+            for i, strategy in enumerate(strategies)
+        ]
+        pending = set(tasks)
         last_error = None
         
-        for strategy in strategies:
-            try:
-                print(f"Trying extraction strategy: {strategy['name']}")
-                
-                # Get base options
-                use_browser_cookies = strategy['opts'].pop('use_browser_cookies', False)
-                ydl_opts = self.get_ydl_opts(download=False, use_browser_cookies=use_browser_cookies)
-                
-                # Apply strategy-specific options
-                ydl_opts.update(strategy['opts'])
-                
-                def _extract():
-                    try:
-                        # Much longer delays between fallback strategies
-                        delay = random.uniform(15, 25)
-                        print(f"Strategy {strategy['name']}: waiting {delay:.1f} seconds...")
-                        time.sleep(delay)
-                        
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            return ydl.extract_info(url, download=False)
-                    except Exception as e:
-                        print(f"Strategy {strategy['name']} failed: {e}")
-                        raise
-                
-                # Run in thread pool
-                loop = asyncio.get_event_loop()
-                info = await loop.run_in_executor(None, _extract)
-                
-                if info:
-                    print(f"Success with strategy: {strategy['name']}")
-                    return info
-                    
-            except Exception as e:
-                last_error = e
-                # Much longer wait between strategies to avoid triggering rate limits
-                wait_time = random.uniform(30, 60)
-                print(f"Strategy failed, waiting {wait_time:.1f} seconds before next attempt...")
-                await asyncio.sleep(wait_time)
-                continue
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Prefer the earliest strategy when several finish together
+                for task in tasks:
+                    if task not in done:
+                        continue
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                    elif task.result():
+                        self._remember_info(url, task.result())
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
         
         # If all strategies failed, raise the last error
         if last_error:
             raise last_error
         else:
             raise Exception("All extraction strategies failed")
+    
+    async def _run_strategy(self, url: str, strategy: Dict[str, Any], start_delay: float,
+                            ua_profile: Tuple[str, Dict[str, str]]) -> Optional[Dict[str, Any]]:
+        """Run one extract_info_with_fallback strategy after its staggered start delay"""
+        if start_delay:
+            print(f"Strategy {strategy['name']}: waiting {start_delay:.1f} seconds...")
+            await asyncio.sleep(start_delay)
+        print(f"Trying extraction strategy: {strategy['name']}")
+        
+        # Get base options, then apply strategy-specific options
+        use_browser_cookies = strategy['opts'].pop('use_browser_cookies', False)
+        ydl_opts = {
+            **self.get_ydl_opts(download=False, use_browser_cookies=use_browser_cookies, ua_profile=ua_profile),
+            **strategy['opts'],
+        }
+        
+        # Extractors read their params when the session first initializes them, so every
+        # strategy gets a session built with its own options rather than patching a shared one.
+        # A session keeps the user agent it was built with, so the URL's agent is part of the
+        # key too; that's at most len(UA_PROFILES) sessions per strategy
+        ydl, ydl_lock = self._get_ydl(ydl_opts, 'strategy', strategy['name'], ua_profile[0])
+        
+        def _extract():
+            try:
+                with _session_lock(ydl_lock):
+                    return ydl.extract_info(url, download=False)
+            except Exception as e:
+                print(f"Strategy {strategy['name']} failed: {e}")
+                raise
+        
+        # Run in thread pool
+        loop = asyncio.get_running_loop()
+        async with self._request_slots:
+            await self._rate_limit()
+            try:
+                info = await asyncio.wait_for(loop.run_in_executor(EXTRACT_POOL, _extract), EXTRACT_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise Exception(f"Strategy {strategy['name']} timed out after {EXTRACT_TIMEOUT}s")
+        
+        if info:
+            print(f"Success with strategy: {strategy['name']}")
+        return info
@@ -5,8 +5,9 @@ import asyncio
 import subprocess
 import uvicorn
 import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
@@ -14,8 +15,11 @@ from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import aiofiles
 from dotenv import load_dotenv
-from downloader import VideoDownloader
-from utils import sanitize_filename, format_duration
+from downloader import (
+    VideoDownloader, remove_temp_files, REQUEST_INTERVAL, REQUEST_INTERVAL_FAILURE_STEP,
+    EXTRACT_BACKOFF_BASE, DOWNLOAD_BACKOFF_BASE, MAX_BACKOFF, BACKOFF_JITTER, STRATEGY_STAGGER
+)
+from utils import sanitize_filename, format_duration, usable_hw_encoders, ffmpeg_encoders, stat_file
 
 load_dotenv()
 
@@ -41,13 +45,64 @@ TEMP_DIR = Path("temp")
 DOWNLOADS_DIR.mkdir(exist_ok=True)
 TEMP_DIR.mkdir(exist_ok=True)
 
+@dataclass(slots=True)
+class Task:
+    """State of one download; field names follow StatusResponse"""
+    url: str
+    rename: Optional[str] = None
+    status: str = "processing"
+    progress: str = "starting"
+    message: str = "Initializing download..."
+    videoInfo: Optional[dict] = None
+    filename: Optional[str] = None
+    # Set by download_video_task when it returns, whatever the outcome
+    finished_at: Optional[float] = None
+
 # Task storage (in production, use Redis or database)
-tasks = {}
+tasks: Dict[str, Task] = {}
+# Finished tasks are forgotten TASK_TTL seconds after they finish, or sooner once there are MAX_TASKS of them
+TASK_TTL = 3600
+MAX_TASKS = 10_000
+
+def evict_tasks():
+    """Drop expired finished tasks, earliest finished first; tasks still running are never dropped"""
+    now = time.monotonic()
+    finished = sorted((task.finished_at, task_id) for task_id, task in tasks.items() if task.finished_at is not None)
+    for finished_at, task_id in finished:
+        if len(tasks) < MAX_TASKS and now - finished_at <= TASK_TTL:
+            break
+        del tasks[task_id]
 
 # Session management to prevent rapid requests
 last_request_time = {}
 REQUEST_COOLDOWN = 120  # 2 minutes between requests from same IP
 
+# Uploads are copied to disk in pieces of this size rather than read into memory whole
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# name -> first line of `<name> -version`; failures aren't stored, so a tool that was
+# missing or timed out once is checked again on the next request
+tool_versions: Dict[str, str] = {}
+
+def tool_version(name: str) -> Optional[str]:
+    """First line of `<name> -version`, or None if it can't run; found once per process"""
+    if name in tool_versions:
+        return tool_versions[name]
+    try:
+        result = subprocess.run([name, '-version'], capture_output=True, timeout=10)
+    except Exception:
+        return None
+    if result.returncode != 0:
+        return None
+    tool_versions[name] = result.stdout.decode().split('\n')[0]
+    return tool_versions[name]
+
+@app.on_event("startup")
+async def detect_encoders():
+    """List and trial-run the encoders before serving, so no VideoDownloader() blocks the event loop on them"""
+    await asyncio.to_thread(ffmpeg_encoders)
+    await asyncio.to_thread(usable_hw_encoders)
+
 class DownloadRequest(BaseModel):
     url: str
     rename: Optional[str] = None
@@ -81,20 +136,9 @@ async def health_check():
         downloads_writable = os.access(DOWNLOADS_DIR, os.W_OK)
         temp_writable = os.access(TEMP_DIR, os.W_OK)
         
-        # Test ffmpeg
-        import subprocess
-        try:
-            ffmpeg_result = subprocess.run(['ffmpeg', '-version'], capture_output=True, timeout=10)
-            ffmpeg_available = ffmpeg_result.returncode == 0
-        except:
-            ffmpeg_available = False
-        
-        # Test ffprobe
-        try:
-            ffprobe_result = subprocess.run(['ffprobe', '-version'], capture_output=True, timeout=10)
-            ffprobe_available = ffprobe_result.returncode == 0
-        except:
-            ffprobe_available = False
+        # Test ffmpeg and ffprobe; only the first health check actually runs them
+        ffmpeg_available = await asyncio.to_thread(tool_version, 'ffmpeg') is not None
+        ffprobe_available = await asyncio.to_thread(tool_version, 'ffprobe') is not None
         
         return {
             "status": "healthy",
@@ -124,13 +168,26 @@ async def upload_cookies(cookies: UploadFile = File(...)):
             raise HTTPException(status_code=400, detail="File too large (max 1MB)")
         
         cookies_path = Path("cookies.txt")
-        async with aiofiles.open(cookies_path, 'wb') as f:
-            content = await cookies.read()
-            await f.write(content)
+        # One side file per request, so concurrent uploads can't interleave their writes
+        partial_path = cookies_path.with_name(f"cookies.txt.{uuid.uuid4().hex}.part")
+        
+        # Copy to the side file, then swap it in atomically so yt-dlp never sees half an upload.
+        # Always written: yt-dlp rewrites cookies.txt itself, so an identical re-upload can still
+        # restore cookies the file no longer has
+        try:
+            async with aiofiles.open(partial_path, 'wb') as f:
+                while chunk := await cookies.read(UPLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+            
+            await asyncio.to_thread(os.replace, partial_path, cookies_path)
+        finally:
+            # Only left behind if the copy or the replace failed
+            await asyncio.to_thread(partial_path.unlink, missing_ok=True)
+        VideoDownloader.cookies_replaced()
         
         # Validate the uploaded cookies
         downloader = VideoDownloader()
-        validation_result = downloader.validate_cookies_file()
+        validation_result = await asyncio.to_thread(downloader.validate_cookies_file)
         
         if validation_result["valid"]:
             return {
@@ -193,16 +250,11 @@ async def start_download(request: DownloadRequest, background_tasks: BackgroundT
         
         task_id = str(uuid.uuid4())[:12]
         
+        # New tasks are the only thing that grows the registry, so make room here
+        evict_tasks()
+        
         # Initialize task status
-        tasks[task_id] = {
-            "status": "processing",
-            "progress": "starting",
-            "message": "Initializing download...",
-            "videoInfo": None,
-            "filename": None,
-            "url": request.url,
-            "rename": request.rename
-        }
+        tasks[task_id] = Task(url=request.url, rename=request.rename)
         
         # Start background download task
         background_tasks.add_task(download_video_task, task_id, request.url, request.rename)
@@ -225,11 +277,11 @@ async def get_status(task_id: str):
     
     task = tasks[task_id]
     return StatusResponse(
-        status=task["status"],
-        filename=task.get("filename"),
-        message=task.get("message"),
-        videoInfo=task.get("videoInfo"),
-        progress=task.get("progress")
+        status=task.status,
+        filename=task.filename,
+        message=task.message,
+        videoInfo=task.videoInfo,
+        progress=task.progress
     )
 
 @app.get("/files/{task_id}.mkv")
@@ -237,7 +289,7 @@ async def download_file(task_id: str):
     """Download the converted video file"""
     file_path = DOWNLOADS_DIR / f"{task_id}.mkv"
     
-    if not file_path.exists():
+    if await stat_file(str(file_path)) is None:
         raise HTTPException(status_code=404, detail="File not found or has been cleaned up")
     
     return FileResponse(
@@ -257,12 +309,10 @@ async def cleanup_task(task_id: str):
         
         # Remove files
         file_path = DOWNLOADS_DIR / f"{task_id}.mkv"
-        if file_path.exists():
-            file_path.unlink()
+        await asyncio.to_thread(file_path.unlink, missing_ok=True)
         
         # Remove temp files
-        for temp_file in TEMP_DIR.glob(f"{task_id}_temp.*"):
-            temp_file.unlink()
+        await asyncio.to_thread(remove_temp_files, TEMP_DIR, task_id)
         
         return {"message": "Task cleaned up successfully"}
     except Exception as e:
@@ -276,10 +326,12 @@ async def get_anti_bot_info():
         "approach": "Ultra-conservative timing to avoid YouTube detection",
         "timing_details": {
             "request_cooldown": f"{REQUEST_COOLDOWN} seconds between downloads",
-            "extraction_delay": "10-20 seconds base + 10s per retry",
-            "download_delay": "15-30 seconds base + 15s per retry", 
-            "anti_bot_wait": "30-60 seconds base + 30s per retry",
-            "strategy_wait": "30-60 seconds between fallback strategies"
+            "extraction_delay": f"at least {REQUEST_INTERVAL}s since the last YouTube request + {REQUEST_INTERVAL_FAILURE_STEP}s per recent failure",
+            "download_delay": "same request spacing as extraction, shared by all tasks",
+            # _backoff() is first called with retry_count=1, so the first wait is twice the base
+            "anti_bot_wait": (f"{2 * EXTRACT_BACKOFF_BASE}s (extraction) / {2 * DOWNLOAD_BACKOFF_BASE}s (download), doubling per retry "
+                              f"(up to {MAX_BACKOFF // 60} minutes) + up to {BACKOFF_JITTER}s jitter"),
+            "strategy_wait": f"fallback strategies start {STRATEGY_STAGGER} seconds apart and the first success wins"
         },
         "recommendations": [
             "🎯 NEW ULTRA-CONSERVATIVE APPROACH:",
@@ -295,8 +347,8 @@ async def get_anti_bot_info():
             "",
             "🛡️ Anti-Detection Features:",
             "• 2-minute cooldown between requests",
-            "• Randomized delays at every step",
-            "• Progressive backoff on failures",
+            f"• At least {REQUEST_INTERVAL}s between YouTube requests, more after failures",
+            "• Exponential backoff on failures",
             "• Browser-specific headers and user agents",
             "• Automatic browser cookie extraction",
             "",
@@ -307,7 +359,7 @@ async def get_anti_bot_info():
             "• Try public videos first to test functionality"
         ],
         "current_status": {
-            "active_downloads": len([t for t in tasks.values() if t.get("status") == "processing"]),
+            "active_downloads": len([t for t in tasks.values() if t.status == "processing"]),
             "last_request": max(last_request_time.values()) if last_request_time else None,
             "cooldown_active": (
                 (time.time() - max(last_request_time.values())) < REQUEST_COOLDOWN 
@@ -368,33 +420,29 @@ async def get_troubleshoot_info():
         }
         
         # Check and validate cookies file
-        cookies_validation = downloader.validate_cookies_file()
+        cookies_validation = await asyncio.to_thread(downloader.validate_cookies_file)
         
         # Check ffmpeg availability
-        try:
-            ffmpeg_result = subprocess.run(['ffmpeg', '-version'], capture_output=True, timeout=10)
-            ffmpeg_available = ffmpeg_result.returncode == 0
-            ffmpeg_version = ffmpeg_result.stdout.decode().split('\n')[0] if ffmpeg_available else "Not available"
-        except:
-            ffmpeg_available = False
-            ffmpeg_version = "Not available"
+        ffmpeg_version = await asyncio.to_thread(tool_version, 'ffmpeg')
+        ffmpeg_available = ffmpeg_version is not None
+        ffmpeg_version = ffmpeg_version or "Not available"
         
         # Get current task statistics
         task_stats = {
             "total_tasks": len(tasks),
-            "processing_tasks": len([t for t in tasks.values() if t.get("status") == "processing"]),
-            "ready_tasks": len([t for t in tasks.values() if t.get("status") == "ready"]),
-            "error_tasks": len([t for t in tasks.values() if t.get("status") == "error"]),
+            "processing_tasks": len([t for t in tasks.values() if t.status == "processing"]),
+            "ready_tasks": len([t for t in tasks.values() if t.status == "ready"]),
+            "error_tasks": len([t for t in tasks.values() if t.status == "error"]),
         }
         
         # Recent errors
         recent_errors = []
         for task_id, task in tasks.items():
-            if task.get("status") == "error":
+            if task.status == "error":
                 recent_errors.append({
                     "task_id": task_id,
-                    "message": task.get("message", "Unknown error"),
-                    "url": task.get("url", "Unknown")
+                    "message": task.message,
+                    "url": task.url
                 })
         
         return {
@@ -417,8 +465,9 @@ async def get_troubleshoot_info():
                 "",
                 "⏰ New Timing Expectations:",
                 "• Each download attempt: 1-3 minutes",
-                "• Anti-bot failures: 30-60 second delays", 
-                "• Strategy fallbacks: 30-60 seconds between attempts",
+                f"• Anti-bot failures: retried after {2 * EXTRACT_BACKOFF_BASE}s (extraction) or {2 * DOWNLOAD_BACKOFF_BASE}s (download), "
+                f"doubling each retry up to {MAX_BACKOFF // 60} minutes, plus up to {BACKOFF_JITTER}s jitter",
+                f"• Strategy fallbacks: staggered {STRATEGY_STAGGER} seconds apart, first success wins",
                 "• Total download time: 4-10 minutes per video",
                 "",
                 "If you're still getting 'Sign in to confirm you're not a bot' errors:",
@@ -447,8 +496,8 @@ async def download_video_task(task_id: str, url: str, rename: Optional[str] = No
     
     try:
         # Update status: extracting
-        tasks[task_id]["progress"] = "extracting"
-        tasks[task_id]["message"] = "🔍 Extracting video information (using conservative anti-bot approach - this may take longer)..."
+        tasks[task_id].progress = "extracting"
+        tasks[task_id].message = "🔍 Extracting video information (using conservative anti-bot approach - this may take longer)..."
         
         # Extract video info with fallback strategies
         try:
@@ -458,7 +507,7 @@ async def download_video_task(task_id: str, url: str, rename: Optional[str] = No
             except Exception as e:
                 if "blocked" in str(e).lower() or "bot" in str(e).lower():
                     # Try fallback strategies
-                    tasks[task_id]["message"] = "Standard extraction failed, trying alternative methods..."
+                    tasks[task_id].message = "Standard extraction failed, trying alternative methods..."
                     video_info = await downloader.extract_info_with_fallback(url)
                 else:
                     raise e
@@ -466,31 +515,31 @@ async def download_video_task(task_id: str, url: str, rename: Optional[str] = No
         except Exception as e:
             error_msg = str(e)
             if "video access blocked" in error_msg.lower() or "bot" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ YouTube anti-bot protection triggered.\n\n💡 Solutions:\n• This version uses much longer delays (2-5+ minutes per attempt)\n• Wait at least 10-15 minutes before trying again\n• Try uploading fresh cookies.txt from a logged-in browser session\n• Consider trying a different video first\n• The service enforces 2-minute cooldowns between downloads"
+                tasks[task_id].message = f"❌ YouTube anti-bot protection triggered.\n\n💡 Solutions:\n• Retries already back off from {2 * EXTRACT_BACKOFF_BASE}s, doubling each time\n• Wait at least 10-15 minutes before trying again\n• Try uploading fresh cookies.txt from a logged-in browser session\n• Consider trying a different video first\n• The service enforces 2-minute cooldowns between downloads"
             elif "access forbidden" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ Access forbidden.\n\n💡 This video may be:\n• Region-locked\n• Private or unlisted\n• Require authentication\n\nTry uploading cookies.txt from a logged-in session."
+                tasks[task_id].message = f"❌ Access forbidden.\n\n💡 This video may be:\n• Region-locked\n• Private or unlisted\n• Require authentication\n\nTry uploading cookies.txt from a logged-in session."
             elif "video not found" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ Video not found.\n\n💡 Please check:\n• The URL is correct\n• The video hasn't been deleted\n• The video isn't private"
+                tasks[task_id].message = f"❌ Video not found.\n\n💡 Please check:\n• The URL is correct\n• The video hasn't been deleted\n• The video isn't private"
             elif "max retries exceeded" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ Multiple attempts failed.\n\n💡 YouTube is actively blocking requests. Please:\n• Wait 10-15 minutes before trying again\n• Upload fresh cookies.txt\n• Try a different video"
+                tasks[task_id].message = f"❌ Multiple attempts failed.\n\n💡 YouTube is actively blocking requests. Please:\n• Wait 10-15 minutes before trying again\n• Upload fresh cookies.txt\n• Try a different video"
             else:
-                tasks[task_id]["message"] = f"❌ Extraction failed: {error_msg}"
+                tasks[task_id].message = f"❌ Extraction failed: {error_msg}"
             
-            tasks[task_id]["status"] = "error"
+            tasks[task_id].status = "error"
             raise
         
         if not video_info:
             raise Exception("Could not extract video information")
         
-        tasks[task_id]["videoInfo"] = {
+        tasks[task_id].videoInfo = {
             "title": video_info.get("title", "Unknown"),
             "thumbnail": video_info.get("thumbnail", ""),
             "duration": format_duration(video_info.get("duration", 0))
         }
         
         # Update status: downloading
-        tasks[task_id]["progress"] = "downloading"
-        tasks[task_id]["message"] = f"Downloading: {video_info.get('title', 'Unknown')}"
+        tasks[task_id].progress = "downloading"
+        tasks[task_id].message = f"Downloading: {video_info.get('title', 'Unknown')}"
         
         # Download video
         try:
@@ -498,27 +547,27 @@ async def download_video_task(task_id: str, url: str, rename: Optional[str] = No
         except Exception as e:
             error_msg = str(e)
             if "youtube is blocking" in error_msg.lower() or "bot" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ YouTube is blocking the download.\n\n💡 Solutions:\n• Upload a valid cookies.txt file\n• Wait 10-15 minutes before retrying\n• Try a different video"
+                tasks[task_id].message = f"❌ YouTube is blocking the download.\n\n💡 Solutions:\n• Upload a valid cookies.txt file\n• Wait 10-15 minutes before retrying\n• Try a different video"
             elif "access forbidden" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ Download forbidden.\n\n💡 This video may be:\n• Region-locked\n• Private or require authentication\n• Age-restricted\n\nTry uploading cookies.txt from a logged-in session."
+                tasks[task_id].message = f"❌ Download forbidden.\n\n💡 This video may be:\n• Region-locked\n• Private or require authentication\n• Age-restricted\n\nTry uploading cookies.txt from a logged-in session."
             elif "video not found" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ Video not found during download.\n\n💡 The video may have been:\n• Deleted or made private\n• Moved to a different URL"
+                tasks[task_id].message = f"❌ Video not found during download.\n\n💡 The video may have been:\n• Deleted or made private\n• Moved to a different URL"
             elif "private video" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ This is a private video.\n\n💡 You need to upload cookies.txt from a browser session where you're logged in and have access to this video."
+                tasks[task_id].message = f"❌ This is a private video.\n\n💡 You need to upload cookies.txt from a browser session where you're logged in and have access to this video."
             elif "max retries exceeded" in error_msg.lower():
-                tasks[task_id]["message"] = f"❌ Download failed after multiple attempts.\n\n💡 YouTube is actively blocking requests. Please:\n• Wait 15-30 minutes before trying again\n• Upload fresh cookies.txt\n• Check if the video is still available"
+                tasks[task_id].message = f"❌ Download failed after multiple attempts.\n\n💡 YouTube is actively blocking requests. Please:\n• Wait 15-30 minutes before trying again\n• Upload fresh cookies.txt\n• Check if the video is still available"
             else:
-                tasks[task_id]["message"] = f"❌ Download failed: {error_msg}"
+                tasks[task_id].message = f"❌ Download failed: {error_msg}"
             
-            tasks[task_id]["status"] = "error"
+            tasks[task_id].status = "error"
             raise
         
-        if not temp_file or not temp_file.exists():
+        if not temp_file or await stat_file(str(temp_file)) is None:
             raise Exception("Download failed - no file created")
         
         # Update status: converting
-        tasks[task_id]["progress"] = "converting"
-        tasks[task_id]["message"] = "Converting video to optimized format..."
+        tasks[task_id].progress = "converting"
+        tasks[task_id].message = "Converting video to optimized format..."
         
         # Convert to HEVC/H.264
         output_file = DOWNLOADS_DIR / f"{task_id}.mkv"
@@ -527,42 +576,46 @@ async def download_video_task(task_id: str, url: str, rename: Optional[str] = No
         except Exception as e:
             error_msg = str(e)
             if "hevc encoder" in error_msg.lower():
-                tasks[task_id]["message"] = "⚠️ HEVC not available, using H.264 instead..."
+                tasks[task_id].message = "⚠️ HEVC not available, using H.264 instead..."
                 # The downloader will handle fallback automatically
             else:
-                tasks[task_id]["message"] = f"❌ Conversion failed: {error_msg}"
-                tasks[task_id]["status"] = "error"
+                tasks[task_id].message = f"❌ Conversion failed: {error_msg}"
+                tasks[task_id].status = "error"
                 raise
         
-        if not output_file.exists() or output_file.stat().st_size == 0:
+        output_stat = await stat_file(str(output_file))
+        if output_stat is None or output_stat.st_size == 0:
             raise Exception("Conversion failed - no output file created")
         
         # Clean up temp file
-        if temp_file.exists():
-            temp_file.unlink()
+        await asyncio.to_thread(temp_file.unlink, missing_ok=True)
         
         # Update status: ready
-        tasks[task_id]["status"] = "ready"
-        tasks[task_id]["progress"] = "ready"
-        tasks[task_id]["message"] = "✅ Video ready for download!"
-        tasks[task_id]["filename"] = f"{task_id}.mkv"
+        tasks[task_id].status = "ready"
+        tasks[task_id].progress = "ready"
+        tasks[task_id].message = "✅ Video ready for download!"
+        tasks[task_id].filename = f"{task_id}.mkv"
         
         print(f"Download completed successfully for task {task_id}")
         
     except Exception as e:
-        if tasks[task_id]["status"] != "error":
-            tasks[task_id]["status"] = "error"
-            if not tasks[task_id].get("message", "").startswith("❌"):
-                tasks[task_id]["message"] = f"❌ Error: {str(e)}"
+        if tasks[task_id].status != "error":
+            tasks[task_id].status = "error"
+            if not tasks[task_id].message.startswith("❌"):
+                tasks[task_id].message = f"❌ Error: {str(e)}"
         
         print(f"Download error for task {task_id}: {str(e)}")
         
         # Clean up any temp files on error
         try:
-            for temp_file in TEMP_DIR.glob(f"{task_id}_temp.*"):
-                temp_file.unlink()
+            await asyncio.to_thread(remove_temp_files, TEMP_DIR, task_id)
         except:
             pass
+    
+    finally:
+        # Start the TTL only now, so clients get the full TASK_TTL to poll a result
+        if task_id in tasks:
+            tasks[task_id].finished_at = time.monotonic()
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
@@ -0,0 +1,244 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from convert import VideoConverter, PIPE_OUTPUT
+
+# Probe result of an input that would normally only be remuxed
+COMPATIBLE_INPUT = {"video_codec": "h264", "format_name": "mov,mp4,m4a,3gp,3g2,mj2"}
+
+class ForceReencodeTest(unittest.IsolatedAsyncioTestCase):
+    """force_reencode must never hand back a stream copy, even for inputs a remux would handle"""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+
+        with mock.patch.dict(os.environ, {"CONVERT_TMPDIR": os.path.join(self.tmp.name, "out")}):
+            self.converter = VideoConverter()
+        self.input_path = os.path.join(self.tmp.name, "input.mp4")
+        with open(self.input_path, 'wb') as f:
+            f.write(b'\0' * 4096)
+
+        # Stand-ins for ffmpeg: every run succeeds instantly, so a raced remux would win
+        self.commands = []
+
+        async def exec_ffmpeg(cmd):
+            self.commands.append(cmd)
+            for i, arg in enumerate(cmd):
+                if arg == '-y':
+                    with open(cmd[i + 1], 'wb') as f:
+                        f.write(b'\0' * 4096)
+            return 0
+
+        async def upload_stream(stream, public_id):
+            return {"success": True, "public_id": public_id}
+
+        self.uploader = mock.Mock(upload_stream=upload_stream)
+        for name, value in (
+            ('_probe_input', mock.AsyncMock(return_value=COMPATIBLE_INPUT)),
+            ('_detect_encoders', mock.AsyncMock()),
+            ('_exec_ffmpeg', exec_ffmpeg),
+            ('_check_output', mock.AsyncMock(return_value=True)),
+            ('_run_ffmpeg_streaming', mock.AsyncMock(return_value={"success": False, "error": "encoder failed"})),
+        ):
+            patcher = mock.patch.object(self.converter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assert_no_stream_copy(self, commands):
+        for cmd in commands:
+            self.assertNotIn('copy', cmd)
+
+    async def test_file_output_is_encoded(self):
+        result = await self.converter.convert(self.input_path, force_reencode=True)
+
+        self.assertTrue(result["success"])
+        self.assertTrue(self.commands)
+        self.assert_no_stream_copy(self.commands)
+
+    async def test_streaming_never_falls_back_to_remux(self):
+        result = await self.converter.convert(self.input_path, uploader=self.uploader, force_reencode=True)
+
+        # Both encodes fail in this setup; the stream copy that would have succeeded is not tried
+        self.assertFalse(result["success"])
+        commands = [call.args[0] for call in self.converter._run_ffmpeg_streaming.await_args_list]
+        self.assertTrue(commands)
+        self.assert_no_stream_copy(commands)
+        self.assertTrue(all(PIPE_OUTPUT in cmd for cmd in commands))
+
+    async def test_compatible_input_is_remuxed_without_force(self):
+        result = await self.converter.convert(self.input_path)
+
+        self.assertTrue(result["success"])
+        self.assertIn('copy', self.commands[0])
+
+class RemuxFallbackTest(unittest.IsolatedAsyncioTestCase):
+    """Inputs that need encoding only get a stream copy once both encodes have failed"""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+
+        # Writing straight to disk keeps the tmpfs retry out of the picture
+        with mock.patch.dict(os.environ, {"CONVERT_TMPDIR": "converted"}):
+            self.converter = VideoConverter()
+        self.input_path = os.path.join(self.tmp.name, "input.webm")
+        with open(self.input_path, 'wb') as f:
+            f.write(b'\0' * 4096)
+
+        # Every encode fails; only the stream copy writes its output
+        self.commands = []
+
+        async def exec_ffmpeg(cmd):
+            self.commands.append(cmd)
+            if 'copy' not in cmd:
+                return 1
+            with open(cmd[-1], 'wb') as f:
+                f.write(b'\0' * 4096)
+            return 0
+
+        for name, value in (
+            ('_probe_input', mock.AsyncMock(return_value={"video_codec": "vp9", "format_name": "matroska,webm"})),
+            ('_detect_encoders', mock.AsyncMock()),
+            ('_exec_ffmpeg', exec_ffmpeg),
+            ('_check_output', mock.AsyncMock(side_effect=os.path.exists)),
+        ):
+            patcher = mock.patch.object(self.converter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_remux_is_the_last_resort(self):
+        result = await self.converter.convert(self.input_path)
+
+        self.assertTrue(result["success"])
+        self.assertNotIn('copy', self.commands[0])
+        self.assertIn('copy', self.commands[-1])
+
+    async def test_forced_reencode_skips_the_remux(self):
+        result = await self.converter.convert(self.input_path, force_reencode=True)
+
+        self.assertFalse(result["success"])
+        for cmd in self.commands:
+            self.assertNotIn('copy', cmd)
+
+class TmpfsRetryTest(unittest.IsolatedAsyncioTestCase):
+    """A conversion that fails in tmpfs is only redone on disk if tmpfs was full"""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+
+        self.tmpfs_dir = os.path.join(self.tmp.name, "out")
+        with mock.patch.dict(os.environ, {"CONVERT_TMPDIR": self.tmpfs_dir}):
+            self.converter = VideoConverter()
+        self.input_path = os.path.join(self.tmp.name, "input.webm")
+        with open(self.input_path, 'wb') as f:
+            f.write(b'\0' * 4096)
+
+        # Runs into tmpfs fail, runs to disk succeed
+        self.commands = []
+
+        async def exec_ffmpeg(cmd):
+            self.commands.append(cmd)
+            if any(arg.startswith(self.tmpfs_dir) for arg in cmd):
+                return 1
+            for i, arg in enumerate(cmd):
+                if arg == '-y':
+                    with open(cmd[i + 1], 'wb') as f:
+                        f.write(b'\0' * 4096)
+            return 0
+
+        self.free = 1 << 40
+        for name, value in (
+            ('_probe_input', mock.AsyncMock(return_value={"video_codec": "vp9", "format_name": "matroska,webm"})),
+            ('_detect_encoders', mock.AsyncMock()),
+            ('_exec_ffmpeg', exec_ffmpeg),
+            ('_check_output', mock.AsyncMock(side_effect=os.path.exists)),
+            ('_tmpfs_free', mock.AsyncMock(side_effect=lambda: self.free)),
+        ):
+            patcher = mock.patch.object(self.converter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_full_tmpfs_is_retried_on_disk(self):
+        # Plenty of room when the job reserves its space, none once ffmpeg has run
+        async def fill_tmpfs(*args, **kwargs):
+            self.free = 0
+            return await original(*args, **kwargs)
+        original = self.converter._convert_encoded
+        with mock.patch.object(self.converter, '_convert_encoded', fill_tmpfs):
+            result = await self.converter.convert(self.input_path)
+
+        self.assertTrue(result["success"])
+        self.assertEqual(os.path.dirname(result["file_path"]), self.converter.disk_dir)
+
+    async def test_other_failures_are_not_retried(self):
+        result = await self.converter.convert(self.input_path)
+
+        self.assertFalse(result["success"])
+        for cmd in self.commands:
+            self.assertFalse(any(arg.startswith(self.converter.disk_dir) for arg in cmd))
+
+class ProbeInputTest(unittest.IsolatedAsyncioTestCase):
+    """The real _probe_input, with only ffprobe itself stubbed out"""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+
+        with mock.patch.dict(os.environ, {"CONVERT_TMPDIR": os.path.join(self.tmp.name, "out")}):
+            self.converter = VideoConverter()
+        self.input_path = os.path.join(self.tmp.name, "input.mp4")
+        with open(self.input_path, 'wb') as f:
+            f.write(b'\0' * 4096)
+
+        self.probe = mock.AsyncMock(return_value=COMPATIBLE_INPUT)
+        patcher = mock.patch('convert.probe_video_file', self.probe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_probe_is_cached_per_file_version(self):
+        self.assertEqual(await self.converter._probe_input(self.input_path), COMPATIBLE_INPUT)
+        self.assertEqual(await self.converter._probe_input(self.input_path), COMPATIBLE_INPUT)
+        self.assertEqual(self.probe.await_count, 1)
+
+        # A rewritten file is probed again
+        with open(self.input_path, 'ab') as f:
+            f.write(b'\0')
+        await self.converter._probe_input(self.input_path)
+        self.assertEqual(self.probe.await_count, 2)
+
+    async def test_cache_stays_bounded(self):
+        with mock.patch('convert.PROBE_CACHE_SIZE', 2):
+            for n in range(4):
+                path = os.path.join(self.tmp.name, f"input{n}.mp4")
+                with open(path, 'wb') as f:
+                    f.write(b'\0' * 4096)
+                await self.converter._probe_input(path)
+        self.assertEqual(len(self.converter._probe_cache), 2)
+
+    async def test_convert_gets_past_the_probe(self):
+        with mock.patch.object(self.converter, '_detect_encoders', mock.AsyncMock()), \
+                mock.patch.object(self.converter, '_exec_ffmpeg', mock.AsyncMock(return_value=1)), \
+                mock.patch.object(self.converter, '_check_output', mock.AsyncMock(return_value=False)):
+            result = await self.converter.convert(self.input_path)
+
+        # Every ffmpeg run fails here; what matters is that convert() reached them
+        self.assertEqual(result, {"success": False, "error": "All conversion methods failed"})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,101 @@
 import os
+import re
 import random
+import logging
 import asyncio
+import shutil
+import functools
 import subprocess
-from typing import Dict, List
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+# Messages are only formatted if their level is enabled; routine cleanup logs at DEBUG
+logger = logging.getLogger(__name__)
+
+# Absolute paths, so subprocess can start ffmpeg/ffprobe with posix_spawn
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+FFPROBE = shutil.which('ffprobe') or 'ffprobe'
+# ffprobe invocation that reports format and streams as JSON; append the file path.
+# Only the fields we read are requested, which keeps the output to a few hundred bytes
+FFPROBE_JSON_CMD = (
+    FFPROBE, '-v', 'quiet', '-print_format', 'json',
+    '-show_entries', 'format=format_name,duration:stream=codec_type,codec_name,width,height'
+)
+
+# Simple, safe headers to avoid any list/string issues; built once, one set per user agent
+HEADER_VARIANTS = tuple(
+    MappingProxyType({
+        'User-Agent': user_agent,
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-US,en;q=0.9',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+    for user_agent in (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:120.0) Gecko/20100101 Firefox/120.0'
+    )
+)
+
+# Hardware encoders in order of preference, with the rate-control flags each one needs.
+# Static ffmpeg builds list most of these whether or not the device exists, so
+# usable_hw_encoders() trial-runs each one instead of trusting `ffmpeg -encoders`
+HEVC_HW_ENCODERS = (
+    ('hevc_nvenc', ['-preset', 'p4', '-rc', 'vbr', '-cq', '28']),
+    ('hevc_amf', ['-quality', 'balanced', '-rc', 'cqp', '-qp_i', '28', '-qp_p', '28']),
+    ('hevc_qsv', ['-global_quality', '28']),
+    ('hevc_videotoolbox', ['-q:v', '55']),
+)
+H264_HW_ENCODERS = (
+    ('h264_nvenc', ['-preset', 'p4', '-rc', 'vbr', '-cq', '23']),
+    ('h264_amf', ['-quality', 'balanced', '-rc', 'cqp', '-qp_i', '23', '-qp_p', '23']),
+    ('h264_qsv', ['-global_quality', '23']),
+    ('h264_videotoolbox', ['-q:v', '55']),
+)
+# Seconds allowed for one trial encode; a missing device fails well within it
+ENCODER_TRIAL_TIMEOUT = 15
+
+def _encoder_works(encoder: str, encoder_args: List[str]) -> bool:
+    """Encode one blank frame to check that the encoder, and the device behind it, actually work"""
+    try:
+        result = subprocess.run(
+            [FFMPEG, '-hide_banner', '-v', 'error',
+             '-f', 'lavfi', '-i', 'color=c=black:s=256x256',
+             '-frames:v', '1', '-c:v', encoder, *encoder_args,
+             '-f', 'null', '-'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=ENCODER_TRIAL_TIMEOUT
+        )
+    except Exception:
+        return False
+    return result.returncode == 0
+
+@functools.lru_cache(maxsize=1)
+def ffmpeg_encoders() -> str:
+    """`ffmpeg -encoders` listing (once per process), or "" if it failed; enough to tell whether libx265/libx264 exist
+    
+    Blocks on ffmpeg the first time, so call it from a worker thread.
+    """
+    try:
+        result = subprocess.run([FFMPEG, '-hide_banner', '-encoders'], capture_output=True, text=True, timeout=10)
+        return result.stdout
+    except Exception as e:
+        logger.warning("Encoder detection failed: %s", e)
+        return ""
+
+@functools.lru_cache(maxsize=1)
+def usable_hw_encoders() -> Tuple[List[Tuple[str, List[str]]], List[Tuple[str, List[str]]]]:
+    """(HEVC, H.264) hardware encoders that pass a trial encode, best first; checked once per process
+    
+    Blocks for a few ffmpeg runs the first time, so call it from a worker thread.
+    """
+    hevc = [enc for enc in HEVC_HW_ENCODERS if _encoder_works(*enc)]
+    h264 = [enc for enc in H264_HW_ENCODERS if _encoder_works(*enc)]
+    logger.info("Usable hardware encoders: %s", ', '.join(name for name, _ in hevc + h264) or 'none')
+    return hevc, h264
 
 def setup_directories():
     """Setup required directories"""
@@ -10,61 +103,81 @@ def setup_directories():
     for dir_name in dirs:
         os.makedirs(dir_name, exist_ok=True)
 
-def get_random_headers() -> Dict[str, str]:
-    """Get random browser headers with more realistic patterns"""
-    # Simple, safe headers to avoid any list/string issues
-    user_agents = [
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:120.0) Gecko/20100101 Firefox/120.0'
-    ]
+def get_random_headers() -> Mapping[str, str]:
+    """Get random browser headers with more realistic patterns
     
-    # Return simple, safe headers
-    return {
-        'User-Agent': random.choice(user_agents),
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Accept-Encoding': 'gzip, deflate',
-        'Connection': 'keep-alive'
-    }
+    The returned mapping is shared and read-only; copy it with dict() to modify it.
+    """
+    return random.choice(HEADER_VARIANTS)
+
+# Leading bytes read to recognise an HTML/XML error page saved in place of the video
+HTML_SNIFF_SIZE = 64
+HTML_PREFIXES = (b'<!doctype', b'<html', b'<?xml')
+
+async def spawn_subprocess(*cmd, **kwargs) -> asyncio.subprocess.Process:
+    """Start a subprocess via posix_spawn instead of fork+exec where CPython allows it
+    
+    That needs an absolute executable path and close_fds off (our fds are non-inheritable anyway).
+    """
+    return await asyncio.create_subprocess_exec(*cmd, close_fds=False, start_new_session=False, **kwargs)
+
+async def stat_file(file_path: str) -> Optional[os.stat_result]:
+    """os.stat in a worker thread so slow (network) filesystems don't block the event loop"""
+    try:
+        return await asyncio.to_thread(os.stat, file_path)
+    except OSError:
+        return None
+
+def _size_and_head(file_path: str) -> Optional[Tuple[int, bytes]]:
+    """Size and leading HTML_SNIFF_SIZE bytes of a file from a single open, or None if it can't be opened"""
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        size = os.fstat(fd).st_size
+        try:
+            head = os.read(fd, HTML_SNIFF_SIZE)
+        except OSError:
+            head = b''
+        return size, head
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
 
 async def validate_file_with_ffprobe(file_path: str) -> bool:
     """Validate file using ffprobe with enhanced checks"""
+    return await probe_video_file(file_path) is not None
+
+async def probe_video_file(file_path: str) -> Optional[Dict[str, Any]]:
+    """Validate file using ffprobe and return basic stream info, or None if it is not a usable video"""
     try:
-        if not os.path.exists(file_path):
-            return False
+        # The size check and HTML sniff share one open() and fstat(), off the event loop
+        opened = await asyncio.to_thread(_size_and_head, file_path)
+        if opened is None:
+            return None
+        file_size, head = opened
         
         # Check file size (must be > 1KB)
-        file_size = os.path.getsize(file_path)
         if file_size < 1024:
-            return False
+            return None
         
-        # Check if file is HTML (common issue with restricted videos)
-        try:
-            with open(file_path, 'rb') as f:
-                first_bytes = f.read(2048)  # Read first 2KB
-                if b'<!DOCTYPE html>' in first_bytes or b'<html' in first_bytes:
-                    return False
-                
-                # Check for common error page indicators
-                if b'error' in first_bytes.lower() or b'blocked' in first_bytes.lower():
-                    return False
-        except:
-            pass
+        # Check if file is HTML (common issue with restricted videos). Error pages start with
+        # their doctype/root tag; searching binary data for words like "error" only produced
+        # false positives on real videos
+        if head.lstrip()[:16].lower().startswith(HTML_PREFIXES):
+            return None
         
         # Use ffprobe to validate
-        cmd = [
-            'ffprobe', '-v', 'quiet', '-print_format', 'json',
-            '-show_format', '-show_streams', file_path
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
+        process = await spawn_subprocess(
+            *FFPROBE_JSON_CMD, file_path,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            # Never read, so don't collect it
+            stderr=asyncio.subprocess.DEVNULL
         )
         
-        stdout, stderr = await process.communicate()
+        stdout, _ = await process.communicate()
         
         if process.returncode == 0:
             # Additional check: ensure it has video streams
@@ -74,32 +187,58 @@ async def validate_file_with_ffprobe(file_path: str) -> bool:
                 streams = data.get('streams', [])
                 
                 # Check for video streams
-                has_video = any(stream.get('codec_type') == 'video' for stream in streams)
-                if not has_video:
-                    return False
+                video_stream = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+                if not video_stream:
+                    return None
                 
                 # Check duration (must be > 0)
                 format_info = data.get('format', {})
                 duration = float(format_info.get('duration', 0))
                 if duration <= 0:
-                    return False
+                    return None
                 
-                return True
+                audio_stream = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
+                return {
+                    "format_name": format_info.get('format_name', ''),
+                    "duration": duration,
+                    "video_codec": video_stream.get('codec_name'),
+                    "width": video_stream.get('width'),
+                    "height": video_stream.get('height'),
+                    "audio_codec": audio_stream.get('codec_name')
+                }
             except:
-                return False
+                return None
         
-        return False
+        return None
         
     except Exception as e:
-        print(f"ffprobe validation failed: {e}")
-        return False
+        logger.warning("ffprobe validation failed: %s", e)
+        return None
+
+# Characters that aren't allowed in file names on Windows, macOS or Linux
+UNSAFE_FILENAME_RE = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+def sanitize_filename(filename: str, max_length: int = 200) -> str:
+    """Make a user- or YouTube-supplied title safe to use as a file name"""
+    cleaned = UNSAFE_FILENAME_RE.sub('_', filename).strip(' .')
+    return cleaned[:max_length] or "video"
+
+def format_duration(seconds: Optional[float]) -> str:
+    """Format a duration in seconds as M:SS, or H:MM:SS for an hour or more"""
+    minutes, secs = divmod(int(seconds or 0), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
 
 def cleanup_temp_files(file_paths: List[str]):
     """Clean up temporary files"""
     for file_path in file_paths:
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"Cleaned up: {file_path}")
+            # Just try, instead of an exists() check that can race with the removal
+            os.remove(file_path)
+            logger.debug("Cleaned up: %s", file_path)
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            print(f"Failed to cleanup {file_path}: {e}")
+            logger.warning("Failed to cleanup %s: %s", file_path, e)